@@ -0,0 +1,72 @@
+# -*- mode: python ; coding: utf-8 -*-
+# 起動速度を優先したパッケージング設定。
+#  - onefile ではなく onedir で出力し、起動のたびに一時フォルダへ展開する処理をなくす
+#  - 使用していないQtモジュールと標準ライブラリを除外して、読み込むファイルを減らす
+#  - UPXによる圧縮は展開に時間がかかるため無効にする
+# ビルド: pyinstaller MultiPersonaChat_fast.spec
+
+
+qt_excludes = [
+    'PySide6.Qt3DAnimation', 'PySide6.Qt3DCore', 'PySide6.Qt3DExtras', 'PySide6.Qt3DInput',
+    'PySide6.Qt3DLogic', 'PySide6.Qt3DRender', 'PySide6.QtBluetooth', 'PySide6.QtCharts',
+    'PySide6.QtConcurrent', 'PySide6.QtDataVisualization', 'PySide6.QtDesigner', 'PySide6.QtHelp',
+    'PySide6.QtLocation', 'PySide6.QtMultimedia', 'PySide6.QtMultimediaWidgets', 'PySide6.QtNetwork',
+    'PySide6.QtNetworkAuth', 'PySide6.QtNfc', 'PySide6.QtOpenGL', 'PySide6.QtOpenGLWidgets',
+    'PySide6.QtPdf', 'PySide6.QtPdfWidgets', 'PySide6.QtPositioning', 'PySide6.QtPrintSupport',
+    'PySide6.QtQml', 'PySide6.QtQuick', 'PySide6.QtQuick3D', 'PySide6.QtQuickControls2',
+    'PySide6.QtQuickWidgets', 'PySide6.QtRemoteObjects', 'PySide6.QtScxml', 'PySide6.QtSensors',
+    'PySide6.QtSerialPort', 'PySide6.QtSql', 'PySide6.QtStateMachine', 'PySide6.QtSvg',
+    'PySide6.QtSvgWidgets', 'PySide6.QtTest', 'PySide6.QtTextToSpeech', 'PySide6.QtUiTools',
+    'PySide6.QtWebChannel', 'PySide6.QtWebEngineCore', 'PySide6.QtWebEngineQuick',
+    'PySide6.QtWebEngineWidgets', 'PySide6.QtWebSockets', 'PySide6.QtXml',
+]
+stdlib_excludes = ['tkinter', 'unittest', 'pydoc', 'doctest', 'test', 'lib2to3', 'xmlrpc', 'pdb']
+
+a = Analysis(
+    ['main.py'],
+    pathex=[],
+    binaries=[],
+    datas=[('personas.json', '.')],
+    # 起動を速くするため関数内で遅延インポートしているモジュール
+    hiddenimports=['debate', 'persona_watcher', 'search_index', 'batch_response'],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=qt_excludes + stdlib_excludes,
+    noarchive=False,
+    optimize=1,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='MultiPersonaChat',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='MultiPersonaChat',
+)
+app = BUNDLE(
+    coll,
+    name='MultiPersonaChat.app',
+    icon=None,
+    bundle_identifier=None,
+)
@@ -0,0 +1,56 @@
+import subprocess
+import time
+
+class GeminiBackend:
+    """
+    Gemini CLIの呼び出しを一箇所にまとめるクラス。
+    呼び出しごとにトークン使用量を BudgetManager に記録し、トレース記録中は要求と応答を TraceRecorder に残す。
+    ResultCache で有効にした呼び出し種別は、同じ入力に対する結果を再利用してバックエンドを呼ばない。
+    runner (prompt, call_class, persona_id を受け取って応答を返す関数) を差し替えると、
+    実際のCLIを呼ばずに応答を返せる (replay_trace.py で使用)。
+    """
+    def __init__(self, app, runner=None):
+        self.app = app
+        self.runner = runner or self._run_cli
+
+    def _run_cli(self, prompt, call_class=None, persona_id=None):
+        command = [self.app.gemini_path, "--model", self.app.model_name]
+        # 応答のないCLIを待ち続けると、呼び出し元のワーカースレッドが残り続けるため時間制限を設ける
+        timeout = self.app.config_manager.settings.get("cli_timeout_seconds", 300) or None
+        result = subprocess.run(
+            command, input=prompt, text=True, encoding='utf-8',
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout
+        )
+        return result.stdout
+
+    def generate(self, prompt, call_class, persona_id=None):
+        """
+        プロンプトをGemini CLIに渡し、応答テキストを返す。
+        call_class は budget_manager.CALL_CLASS_NAMES の呼び出し種別のいずれか。
+        1回で複数のペルソナの応答を生成する場合は、persona_id にペルソナIDのリストを渡す。
+        失敗時は subprocess.CalledProcessError, subprocess.TimeoutExpired などをそのまま送出する。
+        """
+        trace_recorder = getattr(self.app, "trace_recorder", None)
+        result_cache = getattr(self.app, "result_cache", None)
+        if result_cache:
+            cached = result_cache.get(prompt, self.app.model_name, call_class)
+            if cached is not None:
+                if trace_recorder: trace_recorder.record("cache_hit", call_class=call_class, persona_id=persona_id)
+                return cached
+        request_id = trace_recorder.begin_request(call_class, persona_id, prompt) if trace_recorder else None
+        started = time.perf_counter()
+        try:
+            response = self.runner(prompt, call_class, persona_id).strip()
+        except Exception as e:
+            if trace_recorder:
+                error = e.stderr.strip() if isinstance(e, subprocess.CalledProcessError) and e.stderr else str(e)
+                trace_recorder.end_request(request_id, (time.perf_counter() - started) * 1000, error=error)
+            # CLIを起動できた後の失敗 (エラー終了・時間切れなど) でも、プロンプトは送っているので消費したものとして記録する
+            if not isinstance(e, OSError):
+                self.app.budget_manager.record(call_class, prompt, "", persona_id)
+            raise
+        if trace_recorder:
+            trace_recorder.end_request(request_id, (time.perf_counter() - started) * 1000, response=response)
+        self.app.budget_manager.record(call_class, prompt, response, persona_id)
+        if result_cache: result_cache.put(prompt, self.app.model_name, call_class, response)
+        return response
@@ -0,0 +1,30 @@
+import json
+import re
+
+def parse_batch_response(text, persona_names):
+    """
+    /ask_all の一括生成の応答 ({"responses": [{"id": ..., "text": ...}, ...]}) を解析し、
+    {ペルソナID: 本文} を返す。persona_names は {ペルソナID: 名前}。
+    JSONとして読めない応答は空の辞書、知らないIDや本文が空の項目は無視する
+    (欠けたペルソナは呼び出し元で個別に生成し直す)。
+    """
+    # ```json ... ``` で囲まれていても、最初の { から最後の } までをJSONとして読む
+    start = text.find("{"); end = text.rfind("}")
+    if start == -1 or end <= start: return {}
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    items = data.get("responses") if isinstance(data, dict) else None
+    if not isinstance(items, list): return {}
+
+    results = {}
+    for item in items:
+        if not isinstance(item, dict): continue
+        persona_id = item.get("id"); body = item.get("text")
+        if persona_id not in persona_names or persona_id in results: continue
+        if not isinstance(body, str): continue
+        # 指示に反して先頭に自分の名前を付けている場合は取り除く
+        body = re.sub(rf"^\s*{re.escape(persona_names[persona_id])}\s*[:：]\s*", "", body).strip()
+        if body: results[persona_id] = body
+    return results
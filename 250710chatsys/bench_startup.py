@@ -0,0 +1,87 @@
+"""
+起動時間のベンチマーク。
+
+  python bench_startup.py [--runs 5] [--top 15]
+
+1. `python -X importtime` で main.py のインポートにかかる時間を計測し、時間のかかるモジュールを表示する。
+2. 環境変数 MPC_STARTUP_BENCH=1 を付けてアプリを複数回起動し、
+   初回描画までの時間 (time-to-first-paint) と操作可能になるまでの時間の中央値を表示する。
+   起動ごとに設定・学習履歴・ペルソナを一時フォルダにコピーし、環境変数 MPC_DATA_DIR でそこを指定するため、
+   計測で実際のデータ (トークン使用量・検索インデックスなど) は書き換わらない。
+   ディスプレイのない環境では QT_QPA_PLATFORM=offscreen を指定して実行してください。
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+# 起動時に読み込まれるデータ (起動時間に影響するため、一時フォルダにコピーして使う)
+SEED_FILES = ["config.json", "learning_history.json", "personas.json", "chat.db", "personas"]
+
+def measure_import_time(top):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=APP_DIR, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        # 形式: "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line: continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    if result.returncode != 0 or not rows:
+        print(f"エラー: main.py のインポートに失敗しました。\n{result.stderr.strip()[-500:]}")
+        return
+    total = next((c for c, _, name in rows if name == "main"), max(c for c, _, _ in rows))
+    print(f"[インポート時間] main: {total / 1000:.1f}ms")
+    print(f"  {'累積(ms)':>10} {'自身(ms)':>10}  モジュール")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name.strip()}")
+
+def seed_data_dir(data_dir):
+    for name in SEED_FILES:
+        source = APP_DIR / name
+        if source.is_dir(): shutil.copytree(source, Path(data_dir) / name)
+        elif source.exists(): shutil.copy2(source, Path(data_dir) / name)
+
+def launch_once(env):
+    # 終了時の保存 (closeEvent) が実際のデータを書き換えないよう、起動ごとに一時フォルダを使う
+    with tempfile.TemporaryDirectory() as data_dir:
+        seed_data_dir(data_dir)
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, str(APP_DIR / "main.py")], cwd=data_dir, env=dict(env, MPC_DATA_DIR=data_dir), text=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60
+        )
+        return result, (time.perf_counter() - started) * 1000
+
+def measure_first_paint(runs):
+    env = dict(os.environ, MPC_STARTUP_BENCH="1")
+    samples = {}
+    for _ in range(runs):
+        result, wall_ms = launch_once(env)
+        line = next((l for l in result.stdout.splitlines() if l.startswith("STARTUP_BENCH")), None)
+        if line is None:
+            print(f"エラー: アプリの起動計測に失敗しました。\n{result.stderr.strip()[-500:]}")
+            return
+        for item in line.split()[1:]:
+            key, value = item.split("=")
+            samples.setdefault(key, []).append(float(value))
+        samples.setdefault("process_wall_ms", []).append(wall_ms)
+    print(f"[起動時間] {runs}回の中央値")
+    for key, values in samples.items():
+        print(f"  {key:>18}: {statistics.median(values):8.1f}ms (最小 {min(values):.1f} / 最大 {max(values):.1f})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=5, help="起動計測の回数")
+    parser.add_argument("--top", type=int, default=15, help="表示するモジュール数")
+    args = parser.parse_args()
+    measure_import_time(args.top)
+    measure_first_paint(args.runs)
@@ -0,0 +1,166 @@
+import copy
+import math
+import threading
+import time
+from datetime import date
+
+# 予算の残量に応じた段階的な縮退レベル
+LEVEL_NORMAL, LEVEL_REDUCED, LEVEL_LOW, LEVEL_EXHAUSTED = 0, 1, 2, 3
+LEVEL_NAMES = {LEVEL_NORMAL: "通常", LEVEL_REDUCED: "節約", LEVEL_LOW: "低残量", LEVEL_EXHAUSTED: "枯渇"}
+# レベルごとの会話履歴の縮小率、自動会話の最大ターン数 (None は無制限)
+CONTEXT_SCALE = {LEVEL_NORMAL: 1.0, LEVEL_REDUCED: 0.6, LEVEL_LOW: 0.4, LEVEL_EXHAUSTED: 0.2}
+AUTOCHAT_TURN_LIMITS = {LEVEL_NORMAL: None, LEVEL_REDUCED: 8, LEVEL_LOW: 3, LEVEL_EXHAUSTED: 0}
+
+CALL_CLASS_NAMES = {
+    "chat": "通常応答", "ask_all": "全員への質問", "ask_all_batch": "全員への質問 (一括)", "autochat": "自動会話", "debate": "討論",
+    "conclusion": "総括", "memory": "記憶更新", "compress": "履歴圧縮",
+}
+
+def estimate_tokens(text):
+    """
+    トークン数をローカルで概算する。
+    英数字は約4文字で1トークン、日本語などの非ASCII文字は約1.5文字で1トークンとして数える。
+    """
+    if not text: return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / 4 + other_chars / 1.5)
+
+def _new_totals():
+    return {"prompt": 0, "response": 0, "total": 0, "calls": 0, "by_persona": {}, "by_class": {}}
+
+class BudgetManager:
+    """
+    トークン使用量をセッション・ペルソナ・呼び出し種別ごとに集計し、
+    日次・セッション予算の残量に応じて動作を段階的に縮退させるクラス。
+    集計は呼び出しのたびには保存せず、flush() (定期的に呼ばれる)・動作モードの切り替え時・終了時にまとめて保存する。
+    """
+    def __init__(self, app):
+        self.app = app
+        self.storage = self.app.storage
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock() # 保存の順序が入れ替わって古い集計で上書きしないようにする
+        self.dirty = False
+        self.session_id = time.strftime("%Y%m%d-%H%M%S")
+        self.session = _new_totals()
+        self.usage = self.load_usage()
+        self.last_level = self.level()
+
+    def load_usage(self):
+        try:
+            usage = self.storage.load_usage()
+            if usage: return usage
+        except Exception as e:
+            print(f"エラー: トークン使用量の読み込みに失敗: {e}")
+        return {"daily": {}, "sessions": {}}
+
+    def save_usage(self):
+        with self.save_lock:
+            with self.lock:
+                self.usage.setdefault("sessions", {})[self.session_id] = self.session
+                # 古い記録はセッションは直近30件、日次は直近90日分だけ残す
+                for old_id in sorted(self.usage["sessions"])[:-30]:
+                    del self.usage["sessions"][old_id]
+                for old_day in sorted(self.usage.setdefault("daily", {}))[:-90]:
+                    del self.usage["daily"][old_day]
+                usage = copy.deepcopy(self.usage); self.dirty = False
+            # 書き込み中も他のスレッドが集計を続けられるよう、コピーを保存する
+            try:
+                self.storage.save_usage(usage)
+            except Exception as e:
+                print(f"エラー: トークン使用量の保存に失敗: {e}")
+
+    def flush(self):
+        """前回の保存以降に集計が変わっていれば保存する"""
+        if self.dirty: self.save_usage()
+
+    def _today(self):
+        return self.usage.setdefault("daily", {}).setdefault(date.today().isoformat(), _new_totals())
+
+    def record(self, call_class, prompt, response, persona_id=None):
+        """
+        1回のバックエンド呼び出しのトークン数を集計に加える。ワーカースレッドから呼ばれる。
+        persona_id にリストを渡すと (/ask_all の一括生成など)、トークン数をそのペルソナたちに等分して加える。
+        """
+        prompt_tokens = estimate_tokens(prompt); response_tokens = estimate_tokens(response)
+        persona_ids = list(persona_id) if isinstance(persona_id, (list, tuple)) else ([persona_id] if persona_id else [])
+        shares = {}
+        if persona_ids:
+            base, remainder = divmod(prompt_tokens + response_tokens, len(persona_ids))
+            for i, pid in enumerate(persona_ids): shares[pid] = shares.get(pid, 0) + base + (1 if i < remainder else 0)
+        with self.lock:
+            for totals in (self.session, self._today()):
+                totals["prompt"] += prompt_tokens
+                totals["response"] += response_tokens
+                totals["total"] += prompt_tokens + response_tokens
+                totals["calls"] += 1
+                by_class = totals["by_class"]
+                by_class[call_class] = by_class.get(call_class, 0) + prompt_tokens + response_tokens
+                by_persona = totals["by_persona"]
+                for pid, tokens in shares.items(): by_persona[pid] = by_persona.get(pid, 0) + tokens
+            self.dirty = True
+        self._notify_level_change()
+
+    # --- 予算と縮退 ---
+    def get_budgets(self):
+        settings = self.app.config_manager.settings
+        return settings.get("daily_token_budget", 0), settings.get("session_token_budget", 0)
+
+    def remaining_ratio(self):
+        """日次・セッション予算のうち残りが少ない方の割合を返す。予算未設定なら None。"""
+        daily_budget, session_budget = self.get_budgets()
+        ratios = []
+        with self.lock:
+            if daily_budget > 0: ratios.append(1 - self._today()["total"] / daily_budget)
+            if session_budget > 0: ratios.append(1 - self.session["total"] / session_budget)
+        return max(0.0, min(ratios)) if ratios else None
+
+    def level(self):
+        ratio = self.remaining_ratio()
+        if ratio is None or ratio > 0.5: return LEVEL_NORMAL
+        if ratio > 0.2: return LEVEL_REDUCED
+        if ratio > 0: return LEVEL_LOW
+        return LEVEL_EXHAUSTED
+
+    def _notify_level_change(self):
+        level = self.level()
+        if level == self.last_level: return
+        self.last_level = level
+        self.save_usage()
+        if level == LEVEL_NORMAL: return
+        message = f"トークン予算の残りが少なくなったため、動作を「{LEVEL_NAMES[level]}」モードに切り替えます。"
+        state = getattr(self.app, "conversation_state", None)
+        if state: state.post_system(message)
+        else: print(f"情報: {message}")
+
+    def history_window(self, default):
+        """プロンプトに含める会話履歴の件数を返す。"""
+        return max(2, int(default * CONTEXT_SCALE[self.level()]))
+
+    def max_autochat_turns(self):
+        """自動会話の最大ターン数を返す。None は無制限。"""
+        return AUTOCHAT_TURN_LIMITS[self.level()]
+
+    def should_defer_memory_update(self):
+        """記憶の統合(要約更新)を後回しにすべきかどうか。"""
+        return self.level() >= LEVEL_LOW
+
+    # --- /budget 表示 ---
+    def _format_totals(self, title, totals, budget):
+        budget_text = f" / 予算 {budget:,}" if budget > 0 else " (予算なし)"
+        lines = [f"[{title}] 合計 {totals['total']:,} トークン{budget_text} "
+                 f"(入力 {totals['prompt']:,} / 出力 {totals['response']:,} / {totals['calls']}回)"]
+        for call_class, tokens in sorted(totals["by_class"].items(), key=lambda x: -x[1]):
+            lines.append(f"  - {CALL_CLASS_NAMES.get(call_class, call_class)}: {tokens:,}")
+        for persona_id, tokens in sorted(totals["by_persona"].items(), key=lambda x: -x[1]):
+            persona = self.app.persona_manager.get_persona_by_id(persona_id)
+            lines.append(f"  - {persona.name if persona else persona_id}: {tokens:,}")
+        return "\n".join(lines)
+
+    def report(self):
+        daily_budget, session_budget = self.get_budgets()
+        with self.lock:
+            session_text = self._format_totals("このセッション", self.session, session_budget)
+            daily_text = self._format_totals("本日", self._today(), daily_budget)
+        return (f"トークン使用量 (概算):\n{session_text}\n{daily_text}\n"
+                f"現在の動作モード: {LEVEL_NAMES[self.level()]}")
@@ -1,19 +1,21 @@
-import json
-from pathlib import Path
 import threading
 import subprocess
 import random
+import time
+
+from result_cache import CACHEABLE_CLASSES
 
 class ConfigManager:
     def __init__(self, app):
         self.app = app
-        self.config_file = Path("config.json")
+        self.storage = self.app.storage
         self.settings = self.load_settings()
         self.user_name = self.settings.get("user_name", "User")
         self.is_compressing = False
 
         self.commands = {
             "/ask_all": {"func": self.ask_all, "desc": "参加者全員に問いかけます。 例: /ask_all 今日の気分は？"},
+            "/ask_all_mode": {"func": self.ask_all_mode, "desc": "/ask_all の生成方法を切り替えます (batch: 1回の呼び出しで全員分 / individual: 1人ずつ)。 例: /ask_all_mode batch"},
             "/help": {"func": self.show_help, "desc": "利用可能なコマンド一覧。"},
             "/group": {"func": self.group_personas, "desc": "参加者をグループ分けします。/group help 参照。"},
             "/join": {"func": self.join_persona, "desc": "ペルソナを会話に参加させます。 例: /join 莉子"},
@@ -23,7 +25,12 @@ class ConfigManager:
             "/save": {"func": self.save_session, "desc": "現在の会話を保存します。 例: /save my_session"},
             "/load": {"func": self.load_session, "desc": "会話を再開します。 例: /load my_session"},
             "/nick": {"func": self.set_nickname, "desc": "あなたの名前を設定します。 例: /nick 田中"},
-            "/compress": {"func": self.manual_compress_history, "desc": "会話履歴を手動で圧縮します。"}
+            "/compress": {"func": self.manual_compress_history, "desc": "会話履歴を手動で圧縮します。"},
+            "/search": {"func": self.search, "desc": "保存済みの会話と記憶を全文検索します。 例: /search 図書館"},
+            "/trace": {"func": self.trace_command, "desc": "操作とAI応答をトレースファイルに記録します。 例: /trace start my_trace | /trace stop"},
+            "/cache": {"func": self.cache_command, "desc": "結果キャッシュの状態を表示します。 例: /cache on memory | /cache off compress | /cache clear"},
+            "/budget": {"func": self.show_budget, "desc": "トークン使用量と予算を表示します。 例: /budget daily 200000 | /budget session 50000"},
+            "/mem": {"func": self.memory_command, "desc": "メモリ使用量と上限を表示します。 例: /mem | /mem top | /mem compact | /mem cap history 1000"}
         }
     
     def ask_all(self, args):
@@ -34,6 +41,15 @@ class ConfigManager:
         question = " ".join(args)
         self.app.ui.trigger_all_personas_response(question)
 
+    def ask_all_mode(self, args):
+        current = "batch" if self.settings.get("ask_all_batched", False) else "individual"
+        if not args:
+            self.app.ui.display_message("System", f"/ask_all の生成方法: {current} (変更するには /ask_all_mode batch | individual)"); return
+        if args[0] not in ("batch", "individual"):
+            self.app.ui.display_message("System", "使用法: /ask_all_mode | /ask_all_mode batch | /ask_all_mode individual"); return
+        self.settings["ask_all_batched"] = args[0] == "batch"; self.save_settings()
+        self.app.ui.display_message("System", f"/ask_all の生成方法を {args[0]} にしました。")
+
     def trigger_compression(self):
         if self.is_compressing: return
         self.is_compressing = True
@@ -47,53 +63,38 @@ class ConfigManager:
         threading.Thread(target=self._compress_logic, daemon=True).start()
 
     def _compress_logic(self):
-        history = self.app.ui.history
+        # ワーカースレッドで実行される。履歴の置き換えと表示は ConversationState に任せる
+        state = self.app.conversation_state
+        generation, history = state.history_snapshot()
         if len(history) < 20:
-            self.app.ui.display_message("System", "履歴が20件未満のため、圧縮は不要です。")
+            state.post_system("履歴が20件未満のため、圧縮は不要です。")
             self.is_compressing = False
             return
         
         split_point = int(len(history) * 0.8)
-        to_compress = history[:split_point]; remaining = history[split_point:]
+        to_compress = history[:split_point]
         history_text = "\n".join(to_compress)
         prompt = f"以下の会話を、今後の文脈として残すために1-2文で超要約してください:\n\n---\n{history_text}\n---"
         
         summary = ""
         try:
-            # ▼▼▼ 修正箇所 ▼▼▼
-            # シンプルな単一モデル呼び出しに戻す
-            command = [self.app.gemini_path, "--model", self.app.model_name]
-            result = subprocess.run(
-                command, input=prompt, text=True, encoding='utf-8',
-                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            summary = result.stdout.strip() or "要約失敗"
-            self.app.ui.history = [f"System: [これまでの会話の要約] {summary}"] + remaining
-            self.app.ui.chat_display.clear()
-            for line in self.app.ui.history:
-                parts = line.split(":", 1)
-                if len(parts) == 2:
-                    self.app.ui.display_message(parts[0].strip(), parts[1].strip())
-            self.app.ui.display_message("System", "履歴の圧縮が完了しました。")
-            # ▲▲▲ 修正箇所 ▲▲▲
+            summary = self.app.backend.generate(prompt, "compress") or "要約失敗"
+            state.compress_history(generation, split_point, f"System: [これまでの会話の要約] {summary}")
         except Exception as e:
             error_message = f"履歴の圧縮中にエラーが発生しました: {e}"
             if isinstance(e, subprocess.CalledProcessError):
                 error_message = f"履歴の圧縮中にAI応答エラー: {e.stderr.strip()}"
-            self.app.ui.display_message("System", error_message)
+            state.post_system(error_message)
         finally:
             self.is_compressing = False
 
     def load_settings(self):
-        if self.config_file.exists():
-            try:
-                with open(self.config_file, 'r', encoding='utf-8') as f: return json.load(f)
-            except: pass
+        try: return self.storage.load_settings()
+        except Exception as e: print(f"エラー: 設定の読み込みに失敗: {e}")
         return {"user_name": "User"}
 
     def save_settings(self):
-        try:
-            with open(self.config_file, 'w', encoding='utf-8') as f: json.dump(self.settings, f, ensure_ascii=False, indent=4)
+        try: self.storage.save_settings(self.settings)
         except Exception as e: print(f"エラー: 設定の保存に失敗: {e}")
 
     def execute_command(self, command_string):
@@ -103,6 +104,65 @@ class ConfigManager:
             except Exception as e: self.app.ui.display_message("System", f"コマンド実行エラー: {e}")
         else: self.app.ui.display_message("System", f"不明なコマンド: '{command}'")
     
+    def trace_command(self, args):
+        recorder = self.app.trace_recorder
+        if not args:
+            status = f"記録中: {recorder.path}" if recorder.is_active else "記録していません。"
+            self.app.ui.display_message("System", f"トレース: {status}\n使用法: /trace start [名前] | /trace stop"); return
+        if args[0] == "start":
+            name = args[1] if len(args) > 1 else time.strftime("trace-%Y%m%d-%H%M%S")
+            path = self.storage.data_dir / f"{name}.trace.jsonl"
+            recorder.start(path)
+            self.app.ui.display_message("System", f"トレースの記録を開始しました: {path.name}")
+        elif args[0] == "stop":
+            path = recorder.stop()
+            if path: self.app.ui.display_message("System", f"トレースを '{path.name}' に保存しました。 (python replay_trace.py {path.name} で再生できます)")
+            else: self.app.ui.display_message("System", "トレースは記録されていません。")
+        else: self.app.ui.display_message("System", f"不明なサブコマンド: {args[0]}")
+
+    def cache_command(self, args):
+        cache = self.app.result_cache
+        if not args: self.app.ui.display_message("System", cache.report()); return
+        if args[0] == "clear":
+            cache.clear(); self.app.ui.display_message("System", "結果キャッシュを消去しました。"); return
+        if args[0] not in ("on", "off") or len(args) < 2:
+            self.app.ui.display_message("System", "使用法: /cache | /cache on [呼び出し種別] | /cache off [呼び出し種別] | /cache clear"); return
+        call_class = args[1]
+        # 会話の応答 (chat, autochat など) は毎回違う内容であるべきなので、キャッシュできる種別だけを受け付ける
+        if call_class not in CACHEABLE_CLASSES:
+            self.app.ui.display_message("System", f"エラー: キャッシュできない呼び出し種別です: {call_class} (指定できる種別: {', '.join(CACHEABLE_CLASSES)})"); return
+        if args[0] == "on": cache.enabled_classes.add(call_class)
+        else: cache.enabled_classes.discard(call_class)
+        self.settings["cache_call_classes"] = sorted(cache.enabled_classes); self.save_settings()
+        self.app.ui.display_message("System", f"呼び出し種別 '{call_class}' のキャッシュを{'有効' if args[0] == 'on' else '無効'}にしました。")
+
+    def show_budget(self, args):
+        if not args: self.app.ui.display_message("System", self.app.budget_manager.report()); return
+        keys = {"daily": "daily_token_budget", "session": "session_token_budget"}
+        if args[0] not in keys or len(args) < 2:
+            self.app.ui.display_message("System", "使用法: /budget | /budget daily [トークン数] | /budget session [トークン数] (0で無制限)"); return
+        try: limit = int(args[1])
+        except ValueError: self.app.ui.display_message("System", "エラー: トークン数は整数で指定してください。"); return
+        self.settings[keys[args[0]]] = max(0, limit); self.save_settings()
+        label = "日次" if args[0] == "daily" else "セッション"
+        self.app.ui.display_message("System", f"{label}トークン予算を {limit:,} に設定しました。" if limit > 0 else f"{label}トークン予算を無制限にしました。")
+
+    def memory_command(self, args):
+        guard = self.app.memory_guard
+        if not args: self.app.ui.display_message("System", guard.report()); return
+        if args[0] == "top": self.app.ui.display_message("System", guard.top_allocations()); return
+        if args[0] == "compact":
+            self.app.conversation_state.enforce_limits(); actions = guard.compact()
+            self.app.ui.display_message("System", "上限の確認を行いました。" + (f" ({', '.join(actions)})" if actions else "")); return
+        if args[0] != "cap" or len(args) < 3:
+            self.app.ui.display_message("System", "使用法: /mem | /mem top | /mem compact | /mem cap [項目] [上限]\n"
+                                        "項目: history, history_context, sender_colors, display_blocks, learning_buffer, threads"); return
+        try: limit = int(args[2])
+        except ValueError: self.app.ui.display_message("System", "エラー: 上限は整数で指定してください。"); return
+        try: guard.set_cap(args[1], limit)
+        except ValueError as e: self.app.ui.display_message("System", f"エラー: {e}"); return
+        self.app.ui.display_message("System", f"{args[1]} の上限を {limit:,} に設定しました。")
+
     def group_personas(self, args):
         if not args or args[0] == 'help':
             help_text = "/group コマンドの使用法:\n/group random [人数]\n/group gender [男性|女性]\n/group age [10s|20s|...]\n/group all\n/group none"
@@ -154,27 +214,43 @@ class ConfigManager:
 
     def save_session(self, args):
         if not args: self.app.ui.display_message("System", "セッションファイル名を指定してください。"); return
-        session_name = args[0]; session_file = Path(f"{session_name}.session.json")
-        session_data = {"history": self.app.ui.history, "active_persona_ids": list(self.app.persona_manager.active_personas.keys()), "user_name": self.user_name}
+        session_name = args[0]; session_label = self.storage.session_label(session_name)
+        history, timestamps_ms, history_offset = self.app.conversation_state.session_snapshot()
+        # history_offset > 0 のときは、上限で退避済みの行を除いた続きだけを渡す (保存済みの行はストレージ側で残す)
+        session_data = {"history": history, "timestamps_ms": timestamps_ms, "history_offset": history_offset, "active_persona_ids": list(self.app.persona_manager.active_personas.keys()), "user_name": self.user_name}
         try:
-            with open(session_file, 'w', encoding='utf-8') as f: json.dump(session_data, f, ensure_ascii=False, indent=4)
-            self.app.ui.display_message("System", f"セッションを '{session_file}' に保存しました。")
+            self.storage.save_session(session_name, session_data)
+            self.app.ui.display_message("System", f"セッションを {session_label} に保存しました。")
+            if self.app.search_index:
+                threading.Thread(target=self._index_session, args=(session_name, history, timestamps_ms, history_offset), daemon=True).start()
         except Exception as e: self.app.ui.display_message("System", f"セッションの保存に失敗: {e}")
 
+    def _index_session(self, session_name, history, timestamps_ms, history_offset):
+        try: self.app.search_index.index_session(session_name, history, timestamps_ms, history_offset)
+        except Exception as e: print(f"エラー: セッション '{session_name}' の索引更新に失敗: {e}")
+
+    def search(self, args):
+        if not args: self.app.ui.display_message("System", "エラー: /search の後に検索語を続けてください。"); return
+        if not self.app.search_index: self.app.ui.display_message("System", "全文検索インデックスが利用できません。"); return
+        query = " ".join(args)
+        hits = self.app.search_index.search(query)
+        if not hits: self.app.ui.display_message("System", f"「{query}」に一致する発言や記憶は見つかりませんでした。"); return
+        self.app.ui.show_search_results(query, hits)
+
+    def open_session_at(self, session_name, seq):
+        """検索結果から、セッションを再開して該当の発言 (seq は履歴の通し番号) までスクロールする"""
+        self.load_session([session_name])
+        self.app.ui.scroll_to_history_index(seq)
+
     def load_session(self, args):
         if not args: self.app.ui.display_message("System", "セッションファイル名を指定してください。"); return
-        session_name = args[0]; session_file = Path(f"{session_name}.session.json")
-        if not session_file.exists(): self.app.ui.display_message("System", f"エラー: セッションファイル '{session_file}' が見つかりません。"); return
+        session_name = args[0]; session_label = self.storage.session_label(session_name)
+        if not self.storage.session_exists(session_name): self.app.ui.display_message("System", f"エラー: セッション {session_label} が見つかりません。"); return
         try:
-            with open(session_file, 'r', encoding='utf-8') as f: session_data = json.load(f)
-            self.app.ui.history = session_data.get("history", [])
+            session_data = self.storage.load_session(session_name)
             self.app.persona_manager.set_active_personas(session_data.get("active_persona_ids", []))
             self.user_name = session_data.get("user_name", "User"); self.settings['user_name'] = self.user_name
-            self.app.ui.chat_display.clear()
-            for line in self.app.ui.history:
-                parts = line.split(":", 1)
-                if len(parts) == 2:
-                    self.app.ui.display_message(parts[0].strip(), parts[1].strip())
+            self.app.conversation_state.replace_history(session_data.get("history", []), session_data.get("timestamps_ms"), session_data.get("history_offset", 0))
             self.app.ui.update_participant_list()
-            self.app.ui.display_message("System", f"セッション '{session_file}' を再開しました。")
+            self.app.ui.display_message("System", f"セッション {session_label} を再開しました。")
         except Exception as e: self.app.ui.display_message("System", f"セッションの再開に失敗しました: {e}")
@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import deque
+
+from PySide6.QtCore import QObject, Signal, Slot, QTimer, QThread
+
+class ConversationState(QObject):
+    """
+    会話履歴 (history) と討論・雑談の文脈 (history_context) を一元管理するクラス。
+    履歴の変更はすべてイベントとして受け付け、GUIスレッドで順番に適用する。
+    ワーカースレッドからのイベントは短い間隔でまとめて適用し、画面の更新内容を
+    updates_ready シグナルで一度にGUIへ届ける。GUIスレッドからのイベントはその場で適用する。
+    ワーカースレッドが履歴を読むときは recent_history() などのコピーを使う。
+    history_limit / context_limit を設定すると、上限を超えた時点で古い発言を上限の3/4まで減らす
+    (history から外した発言は、ロックを放した後で on_spill に渡してディスクに退避する)。
+    history_offset はこれまでに外した行数で、history[i] は通し番号 history_offset + i の発言になる。
+    timestamps_ms[i] は history[i] が追加された時刻 (ミリ秒のUNIX時刻、不明な場合は None)。
+
+    画面の更新内容は次のタプルのリスト (履歴番号は履歴に入らない表示では None):
+      ("message", 発言者, 本文, 履歴番号)                    メッセージを追加表示する
+      ("typing", 発言者)                                     「入力中...」を表示する
+      ("reply", 発言者, 本文, 自動会話タイマー再開, 履歴番号) 「入力中...」を応答に置き換える
+      ("redraw",)                                            履歴全体を表示し直す
+    """
+    updates_ready = Signal(list)
+    flush_requested = Signal()
+
+    def __init__(self, flush_interval_ms=30):
+        super().__init__()
+        self.history = []
+        self.timestamps_ms = []
+        self.history_context = []
+        self.generation = 0 # 履歴が丸ごと置き換えられるたびに増える (古い圧縮結果の適用を防ぐ)
+        self.history_limit = None; self.context_limit = None
+        self.on_spill = None # 上限を超えて history から外した行のリストを受け取る (GUIスレッドで呼ばれる)
+        self.history_offset = 0
+        self.spilled = []
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.flush_scheduled = False
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(flush_interval_ms)
+        self.flush_timer.timeout.connect(self.flush)
+        # ワーカースレッドから emit されると、GUIスレッドのイベントループ経由で呼ばれる
+        self.flush_requested.connect(self.schedule_flush)
+
+    # --- イベントの受け付け (どのスレッドからでも呼べる) ---
+    def submit(self, op, *args):
+        with self.lock:
+            self.pending.append((op, args))
+            notify = not self.flush_scheduled
+            self.flush_scheduled = True
+        if QThread.currentThread() == self.thread(): self.flush()
+        elif notify: self.flush_requested.emit()
+
+    def add_message(self, speaker, text, to_context=False, display="message", restart_autochat=False):
+        """発言を履歴に追加する。display は "message" (追加表示), "reply" (入力中...を置き換え), None (表示しない)"""
+        self.submit("add_message", speaker, text, to_context, display, restart_autochat)
+
+    def show_typing(self, speaker): self.submit("display", ("typing", speaker))
+    def show_reply(self, speaker, text, restart_autochat=False): self.submit("display", ("reply", speaker, text, restart_autochat, None))
+    def post_system(self, text): self.submit("display", ("message", "System", text, None))
+    def set_context(self, lines): self.submit("set_context", list(lines))
+    def ensure_context_head(self, line): self.submit("ensure_context_head", line)
+    def replace_history(self, lines, timestamps_ms=None, history_offset=0):
+        """
+        履歴を丸ごと置き換える。timestamps_ms は各行の発言時刻、history_offset は先頭の行の通し番号
+        (いずれもセッションに保存されていた場合)。
+        """
+        self.submit("replace_history", list(lines), list(timestamps_ms or []), history_offset)
+    def clear(self): self.submit("clear")
+
+    def enforce_limits(self): self.submit("enforce_limits")
+
+    def compress_history(self, generation, count, summary_line):
+        """先頭 count 件を要約1行に置き換える。圧縮中に履歴が置き換えられていた場合は何もしない。"""
+        self.submit("compress_history", generation, count, summary_line)
+
+    # --- GUIスレッドでの適用 ---
+    @Slot()
+    def schedule_flush(self):
+        if not self.flush_timer.isActive(): self.flush_timer.start()
+
+    @Slot()
+    def flush(self):
+        updates = []
+        with self.lock:
+            self.flush_scheduled = False
+            while self.pending:
+                op, args = self.pending.popleft()
+                getattr(self, f"_apply_{op}")(updates, *args)
+            spilled, self.spilled = self.spilled, []
+        if updates: self.updates_ready.emit(updates)
+        # 退避はファイル書き込みを伴うので、ロックを放してから行う
+        if self.on_spill:
+            for lines in spilled: self.on_spill(lines)
+
+    def _apply_add_message(self, updates, speaker, text, to_context, display, restart_autochat):
+        line = f"{speaker}: {text}"
+        self.history.append(line); self.timestamps_ms.append(int(time.time() * 1000))
+        if to_context: self.history_context.append(line)
+        index = self.history_offset + len(self.history) - 1
+        if display == "message": updates.append(("message", speaker, text, index))
+        elif display == "reply": updates.append(("reply", speaker, text, restart_autochat, index))
+        self._apply_enforce_limits(updates)
+
+    def _apply_display(self, updates, update):
+        updates.append(update)
+
+    def _apply_set_context(self, updates, lines):
+        self.history_context = lines
+
+    def _apply_ensure_context_head(self, updates, line):
+        if not self.history_context or line not in self.history_context[0]:
+            self.history_context.insert(0, line)
+
+    def _apply_replace_history(self, updates, lines, timestamps_ms, history_offset):
+        self.history = lines; self.history_offset = history_offset; self.generation += 1
+        self.timestamps_ms = (timestamps_ms + [None] * len(lines))[:len(lines)]
+        updates.append(("redraw",))
+
+    def _apply_clear(self, updates):
+        self.history = []; self.timestamps_ms = []; self.history_context = []; self.history_offset = 0; self.generation += 1
+        updates.append(("redraw",))
+
+    def _apply_enforce_limits(self, updates):
+        if self.history_limit and len(self.history) > self.history_limit:
+            keep = max(1, self.history_limit * 3 // 4)
+            spilled = self.history[:-keep]
+            self.history = self.history[-keep:]; self.timestamps_ms = self.timestamps_ms[-keep:]; self.history_offset += len(spilled); self.generation += 1
+            # 表示は QTextEdit の段落数の上限で別に縮めるため、ここでは描き直さない
+            self.spilled.append(spilled)
+        if self.context_limit and len(self.history_context) > self.context_limit:
+            # 先頭の討論テーマ (ensure_context_head で入れた行) は残す
+            keep = max(1, self.context_limit * 3 // 4 - 1)
+            self.history_context = self.history_context[:1] + self.history_context[-keep:]
+
+    def _apply_compress_history(self, updates, generation, count, summary_line):
+        if generation != self.generation or count > len(self.history):
+            updates.append(("message", "System", "圧縮中に会話履歴が置き換えられたため、圧縮結果は破棄しました。", None)); return
+        # 圧縮中に追加された発言はそのまま残す
+        self.history = [summary_line] + self.history[count:]; self.generation += 1
+        # 要約の行には、要約した最後の発言の時刻を付ける
+        self.timestamps_ms = self.timestamps_ms[count - 1:count] + self.timestamps_ms[count:] if count else [None] + self.timestamps_ms
+        updates.append(("redraw",))
+        updates.append(("message", "System", "履歴の圧縮が完了しました。", None))
+
+    # --- 読み出し (ワーカースレッドからはコピーを使う) ---
+    def recent_history(self, count):
+        with self.lock: return self.history[-count:]
+
+    def recent_context(self, count):
+        with self.lock: return self.history_context[-count:]
+
+    def history_snapshot(self):
+        """(generation, 履歴のコピー) を返す"""
+        with self.lock: return self.generation, list(self.history)
+
+    def session_snapshot(self):
+        """(履歴のコピー, 発言時刻のコピー, history_offset) を返す (セッションの保存用)"""
+        with self.lock: return list(self.history), list(self.timestamps_ms), self.history_offset
@@ -2,7 +2,6 @@ import threading
 import time
 import random
 import subprocess
-import json
 
 class DebateManager:
     def __init__(self, app):
@@ -15,7 +14,8 @@ class DebateManager:
         self.moderator = None
         self.speakers = []
         self.turn_index = 0
-        self.history_context = []
+        self.autochat_turns = 0
+        self.state = self.app.conversation_state
         self.learning_manager = self.app.learning_manager
 
     def link_comm(self, comm):
@@ -25,31 +25,33 @@ class DebateManager:
         if self.is_debating or self.is_autochatting: return
         self.theme = theme
         self.is_debating = True
-        self.history_context = [f"【討論テーマ】: {self.theme}"]
+        self.state.set_context([f"【討論テーマ】: {self.theme}"])
         active_personas = self.app.persona_manager.get_active_personas()
         if len(active_personas) < 2:
-            self.comm.system_message.emit("討論には最低2人のAIが必要です。"); self.is_debating = False; return
+            self.state.post_system("討論には最低2人のAIが必要です。"); self.is_debating = False; return
         self.moderator = random.choice(active_personas)
         self.speakers = [p for p in active_personas if p.id != self.moderator.id]; random.shuffle(self.speakers)
         self.turn_index = -1
         start_message = (f"討論モードを開始します。\nテーマ: 「{self.theme}」\n司会進行は {self.moderator.name} さんです。")
-        self.comm.system_message.emit(start_message)
+        self.state.post_system(start_message)
         self.thread = threading.Thread(target=self._run_loop, daemon=True); self.thread.start()
 
     def start_autochat(self):
         if self.is_debating or self.is_autochatting: return
         self.is_autochatting = True
-        if not self.history_context or "【雑談中】" not in self.history_context[0]:
-            self.history_context.insert(0, "【雑談中】")
+        self.state.ensure_context_head("【雑談中】")
         self.speakers = self.app.persona_manager.get_active_personas()
         if len(self.speakers) < 2: self.is_autochatting = False; return
-        random.shuffle(self.speakers); self.turn_index = -1
+        if self.app.budget_manager.max_autochat_turns() == 0:
+            self.is_autochatting = False; print("情報: トークン予算が枯渇しているため、自動会話を開始しません。"); return
+        random.shuffle(self.speakers); self.turn_index = -1; self.autochat_turns = 0
+        self.app.trace_recorder.record("autochat_start", speakers=[p.id for p in self.speakers])
         self.thread = threading.Thread(target=self._run_loop, daemon=True); self.thread.start()
 
     def conclude_debate(self):
         if not self.is_debating: return
         self.is_debating = False
-        self.comm.system_message.emit("討論を終了し、司会者が総括します...")
+        self.state.post_system("討論を終了し、司会者が総括します...")
         threading.Thread(target=self._run_conclusion_worker, daemon=True).start()
 
     def _run_conclusion_worker(self):
@@ -57,27 +59,30 @@ class DebateManager:
         speaker = self.moderator
         task_prompt = "あなたは司会です。これまでの議論全体を振り返り、各意見をまとめ、討論を締めくくる総括の弁を述べてください。"
         print(f"総括中... 司会者: {speaker.name}");
-        self.comm.debate_thinking.emit(speaker.name)
+        self.state.show_typing(speaker.name)
         
-        ai_text = self._generate_response(speaker, task_prompt)
+        ai_text = self._generate_response(speaker, task_prompt, "conclusion")
         
-        self.history_context.append(f"{speaker.name}: {ai_text}")
-        self.app.ui.history.append(f"{speaker.name}: {ai_text}")
-        self.comm.debate_response_received.emit(speaker.name, ai_text)
+        self.state.add_message(speaker.name, ai_text, to_context=True, display="reply")
         self.comm.conclusion_finished.emit()
 
     def stop_all_ai_talk(self):
         if self.is_debating:
-            self.is_debating = False; self.comm.system_message.emit("討論モードが中断されました。")
+            self.is_debating = False; self.state.post_system("討論モードが中断されました。")
         if self.is_autochatting:
             self.is_autochatting = False; print("情報: 自動会話を中断しました。")
 
     def _run_loop(self):
-        time.sleep(random.uniform(3, 5))
+        time.sleep(random.uniform(3, 5) * self.app.time_scale)
         while self.is_debating or self.is_autochatting:
             self._run_turn()
+            if self.is_autochatting and not self.is_debating:
+                self.autochat_turns += 1
+                max_turns = self.app.budget_manager.max_autochat_turns()
+                if max_turns is not None and self.autochat_turns >= max_turns:
+                    self.is_autochatting = False; print("情報: トークン予算節約のため、自動会話を一時停止しました。")
             if not (self.is_debating or self.is_autochatting): break
-            time.sleep(random.uniform(5, 10))
+            time.sleep(random.uniform(5, 10) * self.app.time_scale)
         print("情報: 自動会話ループが終了しました。")
 
     def _run_turn(self):
@@ -92,39 +97,31 @@ class DebateManager:
             speaker_index = self.turn_index % len(self.speakers)
             speaker = self.speakers[speaker_index]
             user_name = self.app.config_manager.user_name
-            if len(self.history_context) > 2 and random.random() < 0.15:
+            context_size = len(self.state.recent_context(4))
+            if context_size > 2 and random.random() < 0.15:
                 task_prompt = f"これまでの会話の流れを踏まえ、参加者の一人である「{user_name}」さんに質問を投げかけて、会話に引き込んでください。"
-            elif len(self.history_context) > 3 and random.random() < 0.2:
+            elif context_size > 3 and random.random() < 0.2:
                 task_prompt = "直前の会話の中から興味深いキーワードを一つ選び、それについて深掘りするような質問を投げかけて、会話を盛り上げてください。"
             else:
                 task_prompt = "雑談です。直前の会話の流れを踏まえ、自由に発言してください。新しい話題を始めても構いません。"
 
-        print(f"自動会話中... 次の発言者: {speaker.name}"); self.comm.debate_thinking.emit(speaker.name)
+        print(f"自動会話中... 次の発言者: {speaker.name}"); self.state.show_typing(speaker.name)
         
-        ai_text = self._generate_response(speaker, task_prompt)
+        ai_text = self._generate_response(speaker, task_prompt, "debate" if self.is_debating else "autochat")
 
         if not (self.is_debating or self.is_autochatting): return
         
-        self.history_context.append(f"{speaker.name}: {ai_text}")
-        self.app.ui.history.append(f"{speaker.name}: {ai_text}")
-        self.comm.debate_response_received.emit(speaker.name, ai_text)
+        self.state.add_message(speaker.name, ai_text, to_context=True, display="reply")
 
-    def _generate_response(self, speaker, task_prompt):
+    def _generate_response(self, speaker, task_prompt, call_class):
         final_prompt = self._build_turn_prompt(speaker, task_prompt)
+        last_line = self.state.recent_context(1)
         ai_text = ""
         try:
-            # ▼▼▼ 修正箇所 ▼▼▼
-            # シンプルな単一モデル呼び出しに戻す
-            command = [self.app.gemini_path, "--model", self.app.model_name]
-            result = subprocess.run(
-                command, input=final_prompt, text=True, encoding='utf-8',
-                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            ai_text = result.stdout.strip() or "(…)"
-            if self.history_context:
-                turn_context = f"{self.history_context[-1]}\n{speaker.name}: {ai_text}"
+            ai_text = self.app.backend.generate(final_prompt, call_class, speaker.id) or "(…)"
+            if last_line:
+                turn_context = f"{last_line[0]}\n{speaker.name}: {ai_text}"
                 self.learning_manager.add_to_buffer(speaker.id, turn_context)
-            # ▲▲▲ 修正箇所 ▲▲▲
         except Exception as e:
             error_message = f"エラーが発生しました: {e}"
             if isinstance(e, subprocess.CalledProcessError):
@@ -137,7 +134,7 @@ class DebateManager:
 
     def _build_turn_prompt(self, speaker, task_prompt):
         persona_prompt = speaker.get_prompt_string()
-        history_str = "\n".join(self.history_context[-10:])
+        history_str = "\n".join(self.state.recent_context(self.app.budget_manager.history_window(10)))
         mode_desc = f"【討論テーマ】: {self.theme}" if self.is_debating else "【雑談】"
         user_name = self.app.config_manager.user_name
 
@@ -1,31 +1,49 @@
-import json
-from pathlib import Path
-import subprocess
 import threading
 
 class LearningManager:
     def __init__(self, app):
         self.app = app
-        self.learning_file = Path("learning_history.json")
-        self.summaries = self.load_summaries()
+        self.storage = self.app.storage
+        # 学習履歴はウィンドウ表示後の load() で読み込む
+        self.summaries = {}
+        self.is_loaded = False
         self.history_buffers = {}
         self.update_threshold = 15
+        self.buffer_limit = None # 記憶更新の延期中などに1人分のバッファが溜まりすぎないようにする上限 (MemoryGuard が設定)
+
+    def load(self):
+        if self.is_loaded: return
+        # 読み込み前に更新された記憶があれば、そちらを優先する
+        self.summaries = {**self.load_summaries(), **self.summaries}
+        self.is_loaded = True
 
     def load_summaries(self):
-        if self.learning_file.exists():
-            try:
-                with open(self.learning_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError):
-                return {}
-        return {}
+        try:
+            return self.storage.load_summaries()
+        except Exception as e:
+            print(f"エラー: 学習履歴の読み込みに失敗: {e}")
+            return {}
 
     def save_summaries(self):
+        # 読み込み前に保存すると既存の学習履歴を上書きしてしまうため、何もしない
+        if not self.is_loaded: return
+        try:
+            self.storage.save_summaries(self.summaries)
+        except Exception as e:
+            print(f"エラー: 学習履歴の保存に失敗: {e}")
+
+    def save_summary(self, persona_id):
+        """1人分の記憶だけを保存する (SQLiteでは該当行のみ更新)"""
+        if not self.is_loaded: return
         try:
-            with open(self.learning_file, 'w', encoding='utf-8') as f:
-                json.dump(self.summaries, f, ensure_ascii=False, indent=4)
-        except IOError as e:
+            self.storage.save_summary(persona_id, self.summaries[persona_id])
+        except Exception as e:
             print(f"エラー: 学習履歴の保存に失敗: {e}")
+        search_index = getattr(self.app, "search_index", None)
+        if search_index:
+            persona = self.app.persona_manager.get_persona_by_id(persona_id)
+            try: search_index.index_memory(persona_id, persona.name if persona else persona_id, self.summaries[persona_id])
+            except Exception as e: print(f"エラー: 記憶の索引更新に失敗: {e}")
 
     def get_summary_for(self, persona_id):
         return self.summaries.get(persona_id, "")
@@ -34,8 +52,16 @@ class LearningManager:
         if persona_id not in self.history_buffers:
             self.history_buffers[persona_id] = []
         self.history_buffers[persona_id].append(turn_context)
+        if self.buffer_limit and len(self.history_buffers[persona_id]) > self.buffer_limit:
+            # 古い会話から捨てる (記憶の統合には直近の会話が使われる)
+            del self.history_buffers[persona_id][:-self.buffer_limit]
 
         if len(self.history_buffers[persona_id]) >= self.update_threshold:
+            if self.app.budget_manager.should_defer_memory_update():
+                # 予算が少ない間は記憶の統合を後回しにし、バッファに溜めておく
+                if len(self.history_buffers[persona_id]) == self.update_threshold:
+                    print(f"情報: トークン予算節約のため、{persona_id} の記憶更新を延期します。")
+                return
             self.trigger_summary_update(persona_id)
 
     def trigger_summary_update(self, persona_id):
@@ -64,19 +90,11 @@ class LearningManager:
         )
         
         try:
-            # ▼▼▼ 修正箇所 ▼▼▼
-            # シンプルな単一モデル呼び出しに戻す
-            command = [self.app.gemini_path, "--model", self.app.model_name]
-            result = subprocess.run(
-                command, input=prompt, text=True, encoding='utf-8',
-                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            new_summary = result.stdout.strip()
+            new_summary = self.app.backend.generate(prompt, "memory", persona_id)
             if new_summary:
                 self.summaries[persona_id] = new_summary
-                self.save_summaries()
+                self.save_summary(persona_id)
                 print(f"情報: {persona.name} の学習履歴が正常に更新されました。")
-            # ▲▲▲ 修正箇所 ▲▲▲
         except Exception as e:
             print(f"エラー: {persona.name} の学習履歴の更新中にエラーが発生: {e}")
             if persona_id not in self.history_buffers:
@@ -1,49 +1,159 @@
+import time
+_process_start = time.perf_counter()  # 起動時間計測用 (PySide6のインポート前に記録)
+
+import os
 import sys
-import random
+import threading
 from PySide6.QtWidgets import QApplication, QMainWindow
+from PySide6.QtCore import QTimer
 
 # アプリケーションの各コンポーネントをインポート
+# (討論・自動会話のDebateManagerは最初の描画後に遅延インポートする)
 from ui import UIHandler
-from debate import DebateManager
+from conversation_state import ConversationState
 from config_session_command import ConfigManager
 from persona import PersonaManager
 from learning_manager import LearningManager
+from budget_manager import BudgetManager
+from backend import GeminiBackend
+from storage import create_storage
+from trace_recorder import TraceRecorder
+from result_cache import ResultCache, DEFAULT_CACHED_CLASSES
+from memory_guard import MemoryGuard
 
 class ChatApplication(QMainWindow):
-    def __init__(self):
+    def __init__(self, storage=None, runner=None, time_scale=1.0):
+        """
+        storage と runner (Gemini CLIの代わりに応答を返す関数) は replay_trace.py からの再生時に指定する。
+        time_scale は自動会話の開始タイマーや討論のターン間隔などアプリ内部の待ち時間に掛ける倍率 (再生の倍速用)。
+        """
         super().__init__()
         self.setWindowTitle("Multi-Persona AI Chat")
         self.setGeometry(100, 100, 1200, 800)
 
         # Gemini CLIへのパス (環境に合わせて変更してください)
         self.gemini_path = "/usr/local/bin/gemini"
-        
+
         # ▼▼▼ 修正箇所 ▼▼▼
         # 使用するモデルを、動作確認が取れている単一のモデルに固定
         self.model_name = "gemini-2.5-flash"
         # ▲▲▲ 修正箇所 ▲▲▲
+        self.time_scale = time_scale
 
         # 各マネージャークラスをインスタンス化
+        # (ペルソナ・学習履歴の読み込みは finish_startup まで遅延する)
+        self.storage = storage or create_storage()
+        self.trace_recorder = TraceRecorder()
+        if os.environ.get("MPC_TRACE"):
+            # 環境変数 MPC_TRACE にファイル名を指定すると、起動直後からトレースを記録する
+            self.trace_recorder.start(os.environ["MPC_TRACE"])
         self.persona_manager = PersonaManager()
         self.config_manager = ConfigManager(self)
+        self.budget_manager = BudgetManager(self)
+        # トークン使用量は呼び出しのたびではなく、1分ごとにまとめて保存する
+        self.usage_timer = QTimer(self)
+        self.usage_timer.timeout.connect(self.budget_manager.flush)
+        self.usage_timer.start(60 * 1000)
+        settings = self.config_manager.settings
+        self.result_cache = ResultCache(
+            self.storage.data_dir / "cache",
+            enabled_classes=settings.get("cache_call_classes", DEFAULT_CACHED_CLASSES),
+            max_disk_bytes=settings.get("cache_max_disk_mb", 50) * 1024 * 1024,
+            ttl_seconds=settings.get("cache_ttl_hours", 168) * 3600,
+        )
+        self.backend = GeminiBackend(self, runner)
         self.learning_manager = LearningManager(self)
-        self.debate_manager = DebateManager(self)
+        self.conversation_state = ConversationState()
+        self.debate_manager = None
+        self.search_index = None
+        self.persona_watcher = None
         self.ui = UIHandler(self)
 
+        # UIのセットアップ
+        self.ui.setup_ui()
+
+        # 長時間の連続稼働でメモリが増え続けないよう、構造ごとの上限を設定して定期的に確認する
+        self.memory_guard = MemoryGuard(self, self.storage.data_dir / "history_archive")
+        self.memory_timer = QTimer(self)
+        self.memory_timer.timeout.connect(self.memory_guard.log_periodic)
+        memory_log_minutes = settings.get("memory_log_interval_min", 30)
+        if memory_log_minutes > 0: self.memory_timer.start(memory_log_minutes * 60 * 1000)
+
+        self.first_paint_time = None
+        self.startup_finished = False
+        self.startup_timings = {}
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_time is None:
+            self.first_paint_time = time.perf_counter()
+            QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        """ウィンドウの最初の描画後に、ペルソナ・記憶・自動会話エンジンを読み込む"""
+        if self.startup_finished: return
+        self.startup_finished = True
+        started = time.perf_counter()
+
+        self.persona_manager.load()
+        self.learning_manager.load()
+        self.open_search_index()
+
+        from debate import DebateManager
+        self.debate_manager = DebateManager(self)
         # UIとDebateManagerを連携
         self.ui.link_debate_manager(self.debate_manager)
         self.debate_manager.link_comm(self.ui.comm)
+        self.ui.update_participant_list()
 
-        # UIのセットアップ
-        self.ui.setup_ui()
+        # personas.json の変更を監視し、再起動せずに反映する
+        from persona_watcher import PersonaWatcher
+        self.persona_watcher = PersonaWatcher(self.persona_manager, self.ui.comm.personas_changed.emit)
+        self.persona_watcher.start()
+
+        finished = time.perf_counter()
+        first_paint = self.first_paint_time or started
+        self.startup_timings = {
+            "first_paint_ms": (first_paint - _process_start) * 1000,
+            "deferred_load_ms": (finished - started) * 1000,
+            "ready_ms": (finished - _process_start) * 1000,
+        }
+        print(f"情報: 起動完了 (初回描画 {self.startup_timings['first_paint_ms']:.0f}ms, 操作可能 {self.startup_timings['ready_ms']:.0f}ms)")
+
+    def open_search_index(self):
+        """全文検索インデックスを開き、空であれば保存済みデータから裏で作成する"""
+        from search_index import SearchIndex
+        try:
+            self.search_index = SearchIndex(self.storage.data_dir)
+        except Exception as e:
+            print(f"エラー: 全文検索インデックスを開けませんでした (/search は使用できません): {e}"); return
+        if self.search_index.is_empty():
+            summaries = dict(self.learning_manager.summaries)
+            threading.Thread(target=self.search_index.rebuild, args=(self.storage, summaries, self.persona_manager), daemon=True).start()
 
     def closeEvent(self, event):
         # アプリケーション終了時に学習履歴を保存
         self.learning_manager.save_summaries()
+        self.budget_manager.save_usage()
+        self.trace_recorder.stop()
+        if self.persona_watcher: self.persona_watcher.stop()
         event.accept()
 
-if __name__ == "__main__":
+def main():
     app = QApplication(sys.argv)
     window = ChatApplication()
     window.show()
+    # 描画イベントが届かない環境でも起動処理が必ず完了するようにする
+    QTimer.singleShot(500, window.finish_startup)
+    if os.environ.get("MPC_STARTUP_BENCH"):
+        # bench_startup.py から起動された場合は、計測結果を出力して終了する
+        def report_and_quit():
+            if not window.startup_finished: QTimer.singleShot(10, report_and_quit); return
+            timings = " ".join(f"{k}={v:.1f}" for k, v in window.startup_timings.items())
+            print(f"STARTUP_BENCH {timings}", flush=True)
+            app.quit()
+        QTimer.singleShot(0, report_and_quit)
     sys.exit(app.exec())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import datetime
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+DEFAULT_MEMORY_CAPS = {
+    "history": 2000,         # 会話履歴の行数 (超えたら古い行をディスクに退避)
+    "history_context": 200,  # 討論・自動会話の文脈の行数
+    "sender_colors": 200,    # 発言者ごとの表示色
+    "display_blocks": 3000,  # チャット表示 (QTextEdit) の段落数
+    "learning_buffer": 60,   # 記憶更新待ちの会話 (1人あたり)
+    "threads": 50,           # 生きているスレッド数 (超えたら警告)
+}
+
+CAP_NAMES = {
+    "history": "会話履歴", "history_context": "討論の文脈", "sender_colors": "発言者の表示色",
+    "display_blocks": "チャット表示の段落", "learning_buffer": "記憶更新待ちの会話 (1人あたり)", "threads": "スレッド",
+}
+
+def current_rss_bytes():
+    """
+    現在の常駐メモリ (RSS) をバイト数で返す。/proc が無い環境では最大RSSを返し、
+    どちらも取得できない環境 (Windows) では None を返す。
+    """
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def format_mb(size):
+    return "不明" if size is None else f"{size / 1024 / 1024:.1f} MB"
+
+class MemoryGuard:
+    """
+    長時間動かし続けたときのメモリ使用量を監視し、構造ごとの上限を超えたものを縮めるクラス。
+    会話履歴と討論の文脈は ConversationState、記憶更新待ちのバッファは LearningManager が
+    追加のたびに上限を確認し、表示色・チャット表示・スレッドは compact() でまとめて確認する。
+    会話履歴から外した古い発言は data_dir/history_archive/ に日付ごとのテキストとして追記する。
+    上限は設定 memory_caps で変更できる (/mem cap)。
+    """
+    def __init__(self, app, spill_dir):
+        self.app = app
+        self.spill_dir = Path(spill_dir)
+        self.caps = {**DEFAULT_MEMORY_CAPS, **self.app.config_manager.settings.get("memory_caps", {})}
+        self.stats = Counter()
+        self.last_snapshot = None
+        if os.environ.get("MPC_TRACEMALLOC"): tracemalloc.start()
+        self.apply_caps()
+
+    def apply_caps(self):
+        state = self.app.conversation_state
+        state.history_limit = self.caps["history"]; state.context_limit = self.caps["history_context"]
+        state.on_spill = self.spill_history
+        self.app.learning_manager.buffer_limit = self.caps["learning_buffer"]
+        ui = getattr(self.app, "ui", None)
+        if ui is not None: ui.chat_display.document().setMaximumBlockCount(self.caps["display_blocks"])
+
+    def set_cap(self, name, value):
+        """上限を変更して保存し、すぐに反映する。不正な値のときは ValueError を送出する。"""
+        if name not in DEFAULT_MEMORY_CAPS: raise ValueError(f"不明な項目です: {name}")
+        minimum = self.app.learning_manager.update_threshold if name == "learning_buffer" else 1
+        if value < minimum: raise ValueError(f"{name} の上限は {minimum} 以上にしてください。")
+        self.caps[name] = value
+        overrides = self.app.config_manager.settings.setdefault("memory_caps", {})
+        overrides[name] = value; self.app.config_manager.save_settings()
+        self.apply_caps()
+        self.app.conversation_state.enforce_limits()
+
+    def spill_history(self, lines):
+        # ConversationState から (GUIスレッドで、ロックを放した後に) 呼ばれる
+        if not self.stats["history_spilled"]:
+            self.app.conversation_state.post_system(
+                f"会話履歴が上限 ({self.caps['history']:,} 行) を超えたため、古い発言を {self.spill_dir.name}/ に退避しました。"
+                "退避前に /save で保存した発言はセッションに残りますが、保存していなかった発言はセッションや /search の対象に含まれません。")
+        self.stats["history_spilled"] += len(lines)
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            path = self.spill_dir / f"{datetime.date.today():%Y%m%d}.txt"
+            with open(path, 'a', encoding='utf-8') as f: f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"エラー: 古い会話履歴の退避に失敗しました: {e}")
+
+    def compact(self):
+        """追加時に確認していない構造の上限を確認して縮め、行った処理の説明のリストを返す (GUIスレッドで呼ぶ)"""
+        actions = []
+        ui = getattr(self.app, "ui", None)
+        if ui is not None and len(ui.sender_colors) > self.caps["sender_colors"]:
+            # 参加中のペルソナ以外の、古く登録された発言者から色を忘れる (再登場したら新しい色になる)
+            active = {p.name for p in self.app.persona_manager.get_active_personas()}
+            excess = len(ui.sender_colors) - self.caps["sender_colors"] * 3 // 4
+            for sender in [s for s in ui.sender_colors if s not in active][:excess]: del ui.sender_colors[sender]
+            actions.append("発言者の表示色を削減")
+
+        # ホットリロードで削除されたペルソナの記憶更新待ちバッファは使われないので捨てる
+        learning_manager = self.app.learning_manager
+        stale = [pid for pid in list(learning_manager.history_buffers) if not self.app.persona_manager.get_persona_by_id(pid)]
+        for persona_id in stale: learning_manager.history_buffers.pop(persona_id, None)
+        if stale: actions.append(f"削除済みペルソナの記憶更新待ちを破棄 ({len(stale)} 人)")
+
+        threads = threading.enumerate()
+        if len(threads) > self.caps["threads"]:
+            names = Counter(t.name.split(" ", 1)[-1] for t in threads)
+            detail = ", ".join(f"{name} x{count}" for name, count in names.most_common(5))
+            print(f"警告: 生きているスレッドが {len(threads)} 個あります ({detail})")
+            actions.append(f"スレッド数の上限超過を警告 ({len(threads)})")
+        self.stats["compactions"] += len(actions)
+        return actions
+
+    def qt_object_counts(self):
+        """メインウィンドウ配下の QObject の数を型ごとに数える (GUIなしで動かしている場合は None)"""
+        if not hasattr(self.app, "findChildren"): return None
+        from PySide6.QtCore import QObject
+        return Counter(type(obj).__name__ for obj in self.app.findChildren(QObject))
+
+    def sizes(self):
+        state = self.app.conversation_state
+        buffers = [len(b) for b in list(self.app.learning_manager.history_buffers.values())]
+        ui = getattr(self.app, "ui", None)
+        return {
+            "history": len(state.history), "history_context": len(state.history_context),
+            "sender_colors": len(ui.sender_colors) if ui is not None else 0,
+            "display_blocks": ui.chat_display.document().blockCount() if ui is not None else 0,
+            "learning_buffer": max(buffers, default=0), "threads": threading.active_count(),
+        }
+
+    def report(self):
+        lines = [f"メモリ使用量: RSS {format_mb(current_rss_bytes())}"]
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines[0] += f" / Pythonの割り当て {format_mb(current)} (最大 {format_mb(peak)})"
+        for name, size in self.sizes().items():
+            lines.append(f"  - {CAP_NAMES[name]}: {size:,} / 上限 {self.caps[name]:,}")
+        lines.append(f"  退避した会話履歴: {self.stats['history_spilled']:,} 行")
+        qt_counts = self.qt_object_counts()
+        if qt_counts is not None:
+            top = ", ".join(f"{name} {count}" for name, count in qt_counts.most_common(5))
+            lines.append(f"  Qtオブジェクト: {sum(qt_counts.values()):,} 個 ({top})")
+        return "\n".join(lines)
+
+    def top_allocations(self, limit=10):
+        """tracemalloc のスナップショットを取り、前回からの増加が大きい箇所を返す。初回は計測を開始するだけ。"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(); self.last_snapshot = self._take_snapshot()
+            return "メモリ割り当ての計測を開始しました。しばらく会話してから、もう一度 /mem top を実行してください。"
+        snapshot = self._take_snapshot()
+        if self.last_snapshot is None:
+            stats = snapshot.statistics("lineno"); title = "メモリ割り当ての多い箇所:"
+        else:
+            stats = snapshot.compare_to(self.last_snapshot, "lineno"); title = "前回の /mem top からの増加が大きい箇所:"
+        self.last_snapshot = snapshot
+        return "\n".join([title] + [f"  {stat}" for stat in stats[:limit]])
+
+    def _take_snapshot(self):
+        # tracemalloc 自身の割り当ては除く
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def log_periodic(self):
+        """定期的に呼ばれ、上限の確認と使用量のログ出力を行う"""
+        actions = self.compact()
+        sizes = " ".join(f"{name}={size}" for name, size in self.sizes().items())
+        print(f"情報: メモリ RSS {format_mb(current_rss_bytes())} {sizes}" + (f" ({', '.join(actions)})" if actions else ""))
@@ -1,11 +1,19 @@
 import json
 from pathlib import Path
 
+from storage import get_data_dir
+
 class Persona:
     """
     個々のAIペルソナの全データを保持し、プロンプトを生成するクラス。
     """
     def __init__(self, persona_data):
+        self.update(persona_data)
+
+    def update(self, persona_data):
+        """
+        ペルソナの設定を読み込む。ホットリロード時は同じオブジェクトのまま設定だけを差し替える。
+        """
         # 必須項目
         self.id = persona_data.get('id', 'unknown')
         self.name = persona_data.get('name', '名無し')
@@ -22,11 +30,17 @@ class Persona:
         self.goals = persona_data.get('goals', '')
         self.speaking_style = persona_data.get('speaking_style', '普通に話します。')
         # ▲▲▲ 修正箇所 ▲▲▲
+        # 全項目を設定し終えてから1回の代入で差し替えるため、ワーカースレッドが更新途中の
+        # 新旧の混ざったプロンプトを読むことはない
+        self._prompt_string = self._build_prompt_string()
 
     def get_prompt_string(self):
         """
-        AIに渡すための、構造化された詳細なプロンプト文字列を生成する。
+        AIに渡すための、構造化された詳細なプロンプト文字列を返す (update() で生成済みの文字列)。
         """
+        return self._prompt_string
+
+    def _build_prompt_string(self):
         # ▼▼▼ 修正箇所 (プロンプト生成ロジックの全面改訂) ▼▼▼
         return (
             f"あなたは以下の設定を持つAIペルソナ「{self.name}」です。この設定に厳密に従って応答してください。\n"
@@ -50,31 +64,83 @@ class PersonaManager:
     """
     全てのペルソナを管理し、現在アクティブなペルソナを制御するクラス。
     """
-    def __init__(self):
-        self.persona_file = Path("personas.json")
-        self.all_personas = self._load_all_personas()
+    def __init__(self, data_dir=None):
+        # 設定や学習履歴と同じく、カレントディレクトリではなくアプリのデータフォルダから読み込む
+        data_dir = Path(data_dir) if data_dir else get_data_dir()
+        self.persona_file = data_dir / "personas.json"
+        # このフォルダがあれば、personas.json の代わりに1ファイル1ペルソナの分割ファイルを読み込む
+        self.persona_dir = data_dir / "personas"
+        # 起動を速くするため、personas.json の読み込みはウィンドウ表示後の load() まで遅延する
+        self.all_personas = []
+        self.personas_by_id = {}
+        self.source_data = {} # 読み込み元ファイル -> {id: 設定の辞書} (ホットリロードの差分計算用)
+        self.is_loaded = False
         self.active_personas = {} # 現在会話に参加しているペルソナ (id -> Persona object)
-        # 起動時は全員参加
+
+    def load(self):
+        """personas.jsonを読み込み、起動時は全員を参加させる"""
+        if self.is_loaded: return
+        self.all_personas = self._load_all_personas()
+        self.personas_by_id = {p.id: p for p in self.all_personas}
+        self.is_loaded = True
         self.set_active_personas([p.id for p in self.all_personas])
 
+    def get_source_files(self):
+        """ペルソナの読み込み元ファイルの一覧を返す"""
+        if self.persona_dir.is_dir():
+            return sorted(self.persona_dir.glob("*.json"))
+        return [self.persona_file] if self.persona_file.exists() else []
+
+    def read_source(self, path):
+        """読み込み元ファイルを1つ読み、設定の辞書のリストを返す (1ペルソナだけのファイルも可)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, list) else [data]
+
     def _load_all_personas(self):
-        """personas.jsonから全てのペルソナ情報を読み込む"""
-        if not self.persona_file.exists():
+        """personas.json (または personas/ 以下の分割ファイル) から全てのペルソナ情報を読み込む"""
+        source_files = self.get_source_files()
+        if not source_files:
             print(f"エラー: {self.persona_file} が見つかりません。")
             return []
         
-        try:
-            with open(self.persona_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                personas = [Persona(p_data) for p_data in data]
-                print(f"情報: {len(personas)}体のペルソナを '{self.persona_file}' から読み込みました。")
-                return personas
-        except json.JSONDecodeError:
-            print(f"エラー: {self.persona_file} のJSON形式が正しくありません。")
-            return []
-        except Exception as e:
-            print(f"エラー: ペルソナの読み込み中に予期せぬエラーが発生: {e}")
-            return []
+        personas = []
+        for path in source_files:
+            try:
+                entries = self.read_source(path)
+                personas.extend(Persona(p_data) for p_data in entries)
+                self.source_data[path] = {p_data.get('id', 'unknown'): p_data for p_data in entries}
+            except json.JSONDecodeError:
+                print(f"エラー: {path} のJSON形式が正しくありません。")
+            except Exception as e:
+                print(f"エラー: ペルソナの読み込み中に予期せぬエラーが発生: {e}")
+        print(f"情報: {len(personas)}体のペルソナを '{self.persona_dir if self.persona_dir.is_dir() else self.persona_file}' から読み込みました。")
+        return personas
+
+    def apply_changes(self, changes):
+        """
+        ホットリロードの差分を反映する。変更されたペルソナは同じオブジェクトのまま設定だけを更新するため、
+        参加メンバーや進行中の会話はそのまま維持される。反映内容の説明文を返す。
+        """
+        messages = []
+        for p_data in changes.get("updated", []):
+            persona = self.personas_by_id.get(p_data.get('id'))
+            if persona is None:
+                changes.setdefault("added", []).append(p_data); continue
+            persona.update(p_data)
+            messages.append(f"{persona.name}さんの設定を更新しました。")
+        for p_data in changes.get("added", []):
+            if p_data.get('id') in self.personas_by_id: continue
+            persona = Persona(p_data)
+            self.all_personas.append(persona); self.personas_by_id[persona.id] = persona
+            messages.append(f"{persona.name}さんが追加されました。 (/join {persona.name} で参加できます)")
+        for persona_id in changes.get("removed", []):
+            persona = self.personas_by_id.pop(persona_id, None)
+            if persona is None: continue
+            self.all_personas.remove(persona)
+            self.active_personas.pop(persona_id, None)
+            messages.append(f"{persona.name}さんが一覧から削除されました。")
+        return "\n".join(messages)
 
     def get_all_personas(self):
         """全てのペルソナオブジェクトのリストを返す"""
@@ -82,7 +148,7 @@ class PersonaManager:
 
     def get_persona_by_id(self, persona_id):
         """IDを指定してペルソナオブジェクトを取得する"""
-        return next((p for p in self.all_personas if p.id == persona_id), None)
+        return self.personas_by_id.get(persona_id)
 
     def get_active_personas(self):
         """現在アクティブなペルソナオブジェクトのリストを返す"""
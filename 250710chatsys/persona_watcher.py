@@ -0,0 +1,72 @@
+import json
+import threading
+
+class PersonaWatcher:
+    """
+    personas.json (または personas/ 以下の分割ファイル) の変更をバックグラウンドで監視し、
+    前回読み込んだ内容との差分 {"added": [...], "updated": [...], "removed": [...]} を on_changes に渡すクラス。
+    更新時刻が変わったファイルだけを読み直すため、分割ファイルでは1人分の編集で読み直すのはそのファイルだけで済む
+    (更新時刻の確認は毎回すべてのファイルに対して行う)。personas.json 1つの場合は、編集のたびにファイル全体を
+    読み直して全員分を比較する。差分の反映は on_changes の先 (GUIスレッド) で行う。
+    """
+    def __init__(self, persona_manager, on_changes, interval=1.0):
+        self.persona_manager = persona_manager
+        self.on_changes = on_changes
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.known = {}  # 読み込み元ファイル -> {id: 設定の辞書}
+        self.mtimes = {}
+
+    def start(self):
+        self.known = {path: dict(entries) for path, entries in self.persona_manager.source_data.items()}
+        self.mtimes = self._scan_mtimes()
+        self.thread = threading.Thread(target=self._run, daemon=True); self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _scan_mtimes(self):
+        mtimes = {}
+        for path in self.persona_manager.get_source_files():
+            try: mtimes[path] = path.stat().st_mtime_ns
+            except OSError: pass
+        return mtimes
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try: self.check()
+            except Exception as e: print(f"エラー: ペルソナ設定の監視中にエラーが発生: {e}")
+
+    def check(self):
+        """変更されたファイルだけを読み直して差分を計算し、変更があれば on_changes を呼ぶ"""
+        mtimes = self._scan_mtimes()
+        changed = [path for path, mtime in mtimes.items() if self.mtimes.get(path) != mtime]
+        deleted = [path for path in self.mtimes if path not in mtimes]
+        if not changed and not deleted: return
+        self.mtimes = mtimes
+
+        added, updated, removed = {}, {}, set()
+        for path in changed:
+            try:
+                entries = self.persona_manager.read_source(path)
+            except (json.JSONDecodeError, OSError) as e:
+                # 保存途中のファイルなどは、次に更新されたときに読み直す
+                print(f"エラー: {path} を読み込めませんでした: {e}"); continue
+            new = {p_data.get('id', 'unknown'): p_data for p_data in entries}
+            old = self.known.get(path, {})
+            for persona_id, p_data in new.items():
+                if persona_id not in old: added[persona_id] = p_data
+                elif old[persona_id] != p_data: updated[persona_id] = p_data
+            removed.update(old.keys() - new.keys())
+            self.known[path] = new
+        for path in deleted:
+            removed.update(self.known.pop(path, {}).keys())
+
+        # 別の分割ファイルへ移動しただけのペルソナは、削除ではなく更新として扱う
+        for persona_id in removed & added.keys():
+            updated[persona_id] = added.pop(persona_id)
+        removed -= updated.keys()
+        if added or updated or removed:
+            print(f"情報: ペルソナ設定の変更を検出しました (追加 {len(added)} / 更新 {len(updated)} / 削除 {len(removed)})")
+            self.on_changes({"added": list(added.values()), "updated": list(updated.values()), "removed": sorted(removed)})
@@ -0,0 +1,288 @@
+"""
+トレースの再生による負荷生成ツール。
+
+  python replay_trace.py my_trace.trace.jsonl [--speed 10] [--responses recorded|stub] [--seed 1] [--settings config.json]
+  python replay_trace.py my_trace.trace.jsonl --backend-only [--cache]
+
+/trace start または環境変数 MPC_TRACE で記録したトレースのユーザー操作 (発言・コマンド・討論の開始/停止・履歴のクリア) を、
+記録時と同じ時間間隔 (--speed 倍速) で、画面を表示しない本体 (ChatApplication) に入力する。
+プロンプトの組み立て・発言者の選択・自動会話や討論の進行は現在のコードで行われるため、
+それらの変更前後を同じトレースで比較できる。Gemini CLIは呼ばず、記録された応答と待ち時間 (recorded) か、
+固定の応答 (stub) を返す。記録された応答はプロンプトの文面ではなく、呼び出し種別とペルソナごとの記録順で対応付ける。
+終了後に呼び出し種別ごとの呼び出し回数・プロンプトのトークン数 (記録時との比較)・レイテンシと、
+操作の入力の遅れ (GUIスレッドが塞がっていた時間の目安) を表示する。
+アプリ内部の待ち時間 (自動会話の開始タイマー・討論のターン間隔・/ask_all の発言間隔) も同じ倍率で縮める。
+--backend-only では、記録された backend_request をそのまま GeminiBackend に投入する (結果キャッシュの比較用)。
+ペルソナはアプリのデータフォルダ (main.py と同じフォルダ、または MPC_DATA_DIR) の personas.json から読み込む。
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+from backend import GeminiBackend
+from budget_manager import BudgetManager, estimate_tokens
+from persona import PersonaManager
+from result_cache import ResultCache, CACHEABLE_CLASSES
+from storage import JsonStorage
+from trace_recorder import load_trace
+
+# 再生時に本体へ入力するユーザー操作 (autochat_start などは操作の結果なので入力しない)
+INPUT_KINDS = ("user_message", "command", "debate_start", "debate_stop", "clear_history")
+
+def percentile(values, p):
+    if not values: return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k); upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+class RecordedResponder:
+    """
+    記録された応答を、記録時の待ち時間を speed 倍に縮めて返す。
+    (呼び出し種別, ペルソナ) ごとに記録順で対応付け、そのペルソナの記録が尽きたら同じ呼び出し種別の
+    別の記録を使う。それも無い場合は固定の応答を返し、unmatched に数える。
+    """
+    def __init__(self, events, speed):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.unmatched = 0
+        responses = {e["id"]: e for e in events if e["kind"] == "backend_response"}
+        self.queues = defaultdict(deque)
+        for e in events:
+            if e["kind"] == "backend_request" and e["id"] in responses:
+                self.queues[(e["call_class"], self._persona_key(e.get("persona_id")))].append(responses[e["id"]])
+
+    @staticmethod
+    def _persona_key(persona_id):
+        # 一括生成ではペルソナIDのリストが記録される
+        return tuple(persona_id) if isinstance(persona_id, list) else persona_id
+
+    def _next(self, call_class, persona_id):
+        with self.lock:
+            queue = self.queues.get((call_class, self._persona_key(persona_id)))
+            if not queue:
+                candidates = [q for (c, _), q in self.queues.items() if c == call_class and q]
+                queue = max(candidates, key=len) if candidates else None
+            if queue: return queue.popleft()
+            self.unmatched += 1
+            return None
+
+    def __call__(self, prompt, call_class=None, persona_id=None):
+        recorded = self._next(call_class, persona_id)
+        if recorded is None: return "(記録された応答がありません)"
+        time.sleep(recorded["latency_ms"] / 1000 / self.speed)
+        if not recorded.get("ok", True): raise RuntimeError(recorded.get("error") or "記録された応答エラー")
+        return recorded.get("response") or ""
+
+class StubResponder:
+    """固定の応答を一定の待ち時間で返す"""
+    def __init__(self, latency_ms, speed):
+        self.delay = latency_ms / 1000 / speed
+
+    def __call__(self, prompt, call_class=None, persona_id=None):
+        time.sleep(self.delay)
+        return "(stub response)"
+
+class CallLog:
+    """runner を包み、呼び出しごとの種別・プロンプトのトークン数・所要時間・成否を記録する"""
+    def __init__(self, runner):
+        self.runner = runner
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight = 0
+        self.last_active = time.perf_counter()
+
+    def __call__(self, prompt, call_class=None, persona_id=None):
+        prompt_tokens = estimate_tokens(prompt)
+        with self.lock: self.in_flight += 1
+        begin = time.perf_counter(); ok = True
+        try:
+            return self.runner(prompt, call_class, persona_id)
+        except Exception:
+            ok = False; raise
+        finally:
+            latency_ms = (time.perf_counter() - begin) * 1000
+            with self.lock:
+                self.in_flight -= 1; self.last_active = time.perf_counter()
+                self.calls.append({"call_class": call_class, "latency_ms": latency_ms, "ok": ok, "prompt_tokens": prompt_tokens})
+
+def build_engine(data_dir, runner, settings=None, cached_classes=None):
+    """GUIなしでバックエンド周りだけを持つ最小限のアプリを組み立てる"""
+    app = SimpleNamespace(gemini_path="gemini", model_name="replay")
+    app.storage = JsonStorage(data_dir)
+    app.result_cache = ResultCache(Path(data_dir) / "cache", cached_classes) if cached_classes else None
+    app.config_manager = SimpleNamespace(settings=settings or {})
+    app.persona_manager = PersonaManager()
+    app.trace_recorder = None
+    app.budget_manager = BudgetManager(app)
+    app.backend = GeminiBackend(app, runner)
+    return app
+
+def replay_requests(events, app, speed, max_workers):
+    """記録された backend_request をそのまま GeminiBackend に投入する。(投入の遅れ(ms)のリスト, 所要秒数) を返す。"""
+    requests = [e for e in events if e["kind"] == "backend_request"]
+    lags = []; lags_lock = threading.Lock()
+
+    def run(request, scheduled_s, started_at):
+        with lags_lock: lags.append((time.perf_counter() - started_at - scheduled_s) * 1000)
+        try: app.backend.generate(request["prompt"], request["call_class"], request.get("persona_id"))
+        except Exception: pass
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for request in requests:
+            scheduled_s = request["t_ms"] / 1000 / speed
+            delay = scheduled_s - (time.perf_counter() - started_at)
+            if delay > 0: time.sleep(delay)
+            executor.submit(run, request, scheduled_s, started_at)
+    return lags, time.perf_counter() - started_at
+
+def replay_ui(events, call_log, speed, data_dir, settings, idle_s, tail_s):
+    """
+    画面を表示しない ChatApplication を組み立て、記録されたユーザー操作を記録時の間隔で入力する。
+    最後の操作の後、バックエンドの呼び出しが idle_s 秒途切れるか tail_s 秒経ったら自動会話・討論を止めて終了する。
+    (アプリ, 操作の入力の遅れ(ms)のリスト, 所要秒数) を返す。
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication
+    from PySide6.QtCore import Qt, QTimer
+    from main import ChatApplication
+
+    qt_app = QApplication.instance() or QApplication([])
+    storage = JsonStorage(data_dir)
+    storage.save_settings({"user_name": "User", **settings})
+    window = ChatApplication(storage=storage, runner=call_log, time_scale=1 / speed)
+    window.show(); window.finish_startup()
+    ui = window.ui
+
+    # 再生中に別のトレースを記録し始めないよう /trace は入力しない
+    inputs = [e for e in events if e["kind"] in INPUT_KINDS
+              and not (e["kind"] == "command" and e.get("text", "").split()[:1] == ["/trace"])]
+    lags = []
+    started = time.perf_counter()
+
+    def dispatch(event, scheduled_s):
+        lags.append((time.perf_counter() - started - scheduled_s) * 1000)
+        kind = event["kind"]
+        if kind in ("user_message", "command"):
+            ui.user_input.setText(event["text"]); ui.send_message_event()
+        elif kind == "debate_start":
+            ui.debate_theme_input.setText(event["theme"]); ui.start_debate()
+        elif kind == "debate_stop": ui.conclude_debate_event()
+        elif kind == "clear_history": ui.clear_history()
+
+    # 通常のタイマーは最大5%早く発火することがあるため、入力の予定時刻と遅れの計測には精度の高いタイマーを使う
+    # (PySide6 の QTimer.singleShot には種類と関数を受け取る形が無いため、タイマーを個別に作る)
+    input_timers = []
+    for event in inputs:
+        scheduled_s = event["t_ms"] / 1000 / speed
+        timer = QTimer(); timer.setSingleShot(True); timer.setTimerType(Qt.TimerType.PreciseTimer)
+        timer.timeout.connect(lambda e=event, s=scheduled_s: dispatch(e, s))
+        timer.start(round(scheduled_s * 1000)); input_timers.append(timer)
+
+    last_input_s = inputs[-1]["t_ms"] / 1000 / speed if inputs else 0.0
+    def check_finished():
+        elapsed = time.perf_counter() - started
+        if elapsed < last_input_s or len(lags) < len(inputs): return
+        with call_log.lock:
+            in_flight = call_log.in_flight; idle = time.perf_counter() - call_log.last_active
+        busy = in_flight > 0 or idle < idle_s
+        if busy and elapsed < last_input_s + tail_s: return
+        # 新しいターンを始めないようにし、処理中の呼び出しが終わってから終了する
+        ui.autochat_timer.stop()
+        if window.debate_manager: window.debate_manager.stop_all_ai_talk()
+        if in_flight == 0:
+            poll_timer.stop(); window.close(); qt_app.quit()
+    poll_timer = QTimer(); poll_timer.timeout.connect(check_finished); poll_timer.start(100)
+    qt_app.exec()
+    return window, lags, time.perf_counter() - started
+
+def summarize(calls, lags, wall_s, events, app):
+    recorded = defaultdict(list)
+    for e in events:
+        if e["kind"] == "backend_request":
+            tokens = estimate_tokens(e["prompt"])
+            recorded[e["call_class"]].append(tokens); recorded["(全体)"].append(tokens)
+    by_class = defaultdict(list)
+    for c in calls:
+        by_class[c["call_class"]].append(c); by_class["(全体)"].append(c)
+    report = {"wall_s": wall_s, "trace_s": (events[-1]["t_ms"] / 1000) if events else 0.0,
+              "throughput_rps": len(calls) / wall_s if wall_s > 0 else 0.0,
+              "tokens": app.budget_manager.session["total"], "classes": {},
+              "input_lag_p90": percentile(lags, 90), "input_lag_max": max(lags, default=0.0),
+              "cache": app.result_cache.stats if app.result_cache else None}
+    for call_class in set(by_class) | set(recorded):
+        rows = by_class.get(call_class, []); latencies = [r["latency_ms"] for r in rows]
+        report["classes"][call_class] = {
+            "count": len(rows), "recorded_count": len(recorded.get(call_class, [])),
+            "errors": sum(1 for r in rows if not r["ok"]),
+            "prompt_tokens": statistics.mean(r["prompt_tokens"] for r in rows) if rows else 0.0,
+            "recorded_prompt_tokens": statistics.mean(recorded[call_class]) if recorded.get(call_class) else 0.0,
+            "mean": statistics.mean(latencies) if latencies else 0.0, "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90), "p99": percentile(latencies, 99), "max": max(latencies, default=0.0),
+        }
+    return report
+
+def print_report(report):
+    print(f"再生時間 {report['wall_s']:.2f}s (記録時間 {report['trace_s']:.2f}s) / "
+          f"スループット {report['throughput_rps']:.2f} 件/s / 推定トークン {report['tokens']:,}")
+    print(f"入力の遅れ: p90 {report['input_lag_p90']:.1f}ms / 最大 {report['input_lag_max']:.1f}ms")
+    print(f"  {'種別':<12} {'件数':>6} {'(記録)':>6} {'エラー':>6} {'入力トークン':>10} {'(記録)':>8} "
+          f"{'平均':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'最大':>9} (ms)")
+    for call_class, s in sorted(report["classes"].items()):
+        print(f"  {call_class:<12} {s['count']:>6} {s['recorded_count']:>6} {s['errors']:>6} "
+              f"{s['prompt_tokens']:>10.0f} {s['recorded_prompt_tokens']:>8.0f} {s['mean']:>9.1f} {s['p50']:>9.1f} "
+              f"{s['p90']:>9.1f} {s['p99']:>9.1f} {s['max']:>9.1f}")
+    for call_class, c in sorted((report["cache"] or {}).items()):
+        print(f"  キャッシュ {call_class}: ヒット {c['memory_hits'] + c['disk_hits']} / ミス {c['misses']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="トレースを再生して負荷試験を行う")
+    parser.add_argument("trace", help="トレースファイル (*.trace.jsonl)")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率 (例: 10 で10倍速)")
+    parser.add_argument("--responses", choices=["recorded", "stub"], default="recorded", help="記録された応答を返すか、固定の応答を返すか")
+    parser.add_argument("--stub-latency-ms", type=float, default=800.0, help="stub 応答の待ち時間 (等倍時)")
+    parser.add_argument("--cache", nargs="*", metavar="CALL_CLASS",
+                        help="結果キャッシュを有効にして再生する呼び出し種別 (種別を省略すると memory, compress, conclusion)")
+    parser.add_argument("--seed", type=int, help="乱数の種 (発言者や司会の選び方を毎回同じにする)")
+    parser.add_argument("--settings", help="再生時の設定ファイル (config.json と同じ形式)")
+    parser.add_argument("--idle-s", type=float, default=12.0, help="最後の操作の後、呼び出しがこの秒数途切れたら終了する")
+    parser.add_argument("--tail-s", type=float, default=120.0, help="最後の操作の後、最長でこの秒数で終了する")
+    parser.add_argument("--backend-only", action="store_true", help="ユーザー操作ではなく、記録されたAIへの要求をそのまま再生する")
+    parser.add_argument("--max-workers", type=int, default=8, help="--backend-only で同時に処理する要求の最大数")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    events = load_trace(args.trace)
+    if args.seed is not None: random.seed(args.seed)
+    if args.responses == "recorded": responder = RecordedResponder(events, args.speed)
+    else: responder = StubResponder(args.stub_latency_ms, args.speed)
+    call_log = CallLog(responder)
+    cached_classes = None if args.cache is None else (args.cache or CACHEABLE_CLASSES)
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as data_dir:
+        if args.backend_only:
+            app = build_engine(data_dir, call_log, cached_classes=cached_classes)
+            lags, wall_s = replay_requests(events, app, args.speed, args.max_workers)
+        else:
+            settings = {}
+            if args.settings:
+                with open(args.settings, 'r', encoding='utf-8') as f: settings = json.load(f)
+            if cached_classes is not None or "cache_call_classes" not in settings:
+                settings["cache_call_classes"] = cached_classes or []
+            app, lags, wall_s = replay_ui(events, call_log, args.speed, data_dir, settings, args.idle_s, args.tail_s)
+        report = summarize(call_log.calls, lags, wall_s, events, app)
+    if not call_log.calls: print("再生中にAIの呼び出しがありませんでした。")
+    print_report(report)
+    if isinstance(responder, RecordedResponder) and responder.unmatched:
+        print(f"記録に対応する応答が無く、固定の応答を返した呼び出し: {responder.unmatched} 件")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+# 既定ではどの呼び出し種別もキャッシュしない (/cache on で種別ごとに有効にする)
+DEFAULT_CACHED_CLASSES = []
+# 入力が同じなら結果を再利用してよい呼び出し種別 (有効にする候補)
+CACHEABLE_CLASSES = ["memory", "compress", "conclusion"]
+
+def normalize_prompt(prompt):
+    """改行コード・行末の空白・Unicodeの表記ゆれを揃え、実質的に同じプロンプトが同じキーになるようにする"""
+    text = unicodedata.normalize("NFC", prompt.replace("\r\n", "\n"))
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+def cache_key(prompt, model, call_class):
+    raw = f"{call_class}\0{model}\0{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    決定的なバックエンド呼び出しの結果を再利用する2段構成のキャッシュ。
+    1段目はメモリ上のLRU、2段目はディスク上のファイル (合計サイズの上限を超えたら古い順に削除、TTLで失効)。
+    キーは正規化したプロンプト・モデル名・呼び出し種別のSHA-256。
+    enabled_classes に含まれる呼び出し種別 (CACHEABLE_CLASSES のうち有効にしたもの) だけがキャッシュされる。
+    """
+    def __init__(self, cache_dir, enabled_classes=None, memory_entries=256, max_disk_bytes=50 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.cache_dir = Path(cache_dir)
+        # 設定ファイルに書かれていても、会話の応答などキャッシュできない種別は有効にしない
+        self.enabled_classes = set(DEFAULT_CACHED_CLASSES if enabled_classes is None else enabled_classes) & set(CACHEABLE_CLASSES)
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (作成時刻, 応答)
+        self.disk_sizes = None       # key -> ファイルサイズ (起動を遅くしないよう初回使用時に走査する)
+        self.disk_bytes = 0
+        self.stats = {}
+
+    def is_enabled(self, call_class):
+        return call_class in self.enabled_classes
+
+    def _count(self, call_class, name):
+        counts = self.stats.setdefault(call_class, {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0})
+        counts[name] += 1
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def _scan_disk(self):
+        if self.disk_sizes is not None: return
+        self.disk_sizes = {}
+        if self.cache_dir.exists():
+            for path in self.cache_dir.glob("*.json"):
+                self.disk_sizes[path.stem] = path.stat().st_size
+        self.disk_bytes = sum(self.disk_sizes.values())
+
+    def get(self, prompt, model, call_class):
+        """キャッシュされた応答を返す。無効な種別・未登録・期限切れなら None。"""
+        if not self.is_enabled(call_class): return None
+        key = cache_key(prompt, model, call_class)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self._count(call_class, "memory_hits")
+                return entry[1]
+            self._scan_disk()
+            if key in self.disk_sizes:
+                path = self._path(key)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+                    if now - data["created"] <= self.ttl_seconds:
+                        os.utime(path)  # 最近使ったものほど削除されにくくする
+                        self._remember(key, data["created"], data["response"])
+                        self._count(call_class, "disk_hits")
+                        return data["response"]
+                except (OSError, ValueError, KeyError):
+                    pass
+                self._remove_disk(key)
+            self._count(call_class, "misses")
+        return None
+
+    def put(self, prompt, model, call_class, response):
+        if not self.is_enabled(call_class) or not response: return
+        key = cache_key(prompt, model, call_class)
+        created = time.time()
+        data = json.dumps({"created": created, "call_class": call_class, "model": model, "response": response}, ensure_ascii=False)
+        with self.lock:
+            self._remember(key, created, response)
+            self._scan_disk()
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = self._path(key).with_suffix(".tmp")
+                with open(tmp_path, 'w', encoding='utf-8') as f: f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except OSError as e:
+                print(f"エラー: キャッシュの書き込みに失敗: {e}"); return
+            self.disk_bytes += len(data.encode("utf-8")) - self.disk_sizes.get(key, 0)
+            self.disk_sizes[key] = len(data.encode("utf-8"))
+            self._count(call_class, "stores")
+            self._evict_disk()
+
+    def _remember(self, key, created, response):
+        self.memory[key] = (created, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _remove_disk(self, key):
+        self.disk_bytes -= self.disk_sizes.pop(key, 0)
+        try: self._path(key).unlink()
+        except OSError: pass
+
+    def _evict_disk(self):
+        if self.disk_bytes <= self.max_disk_bytes: return
+        by_age = sorted(self.disk_sizes, key=lambda k: self._path(k).stat().st_mtime if self._path(k).exists() else 0)
+        for key in by_age:
+            if self.disk_bytes <= self.max_disk_bytes: break
+            self._remove_disk(key)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self._scan_disk()
+            for key in list(self.disk_sizes): self._remove_disk(key)
+            self.stats.clear()
+
+    def report(self):
+        with self.lock:
+            self._scan_disk()
+            lines = [f"結果キャッシュ: メモリ {len(self.memory)}/{self.memory_entries}件, "
+                     f"ディスク {len(self.disk_sizes)}件 ({self.disk_bytes / 1024:.1f}KB / {self.max_disk_bytes / 1024 / 1024:.0f}MB), "
+                     f"有効期限 {self.ttl_seconds / 3600:.0f}時間",
+                     f"有効な呼び出し種別: {', '.join(sorted(self.enabled_classes)) or '(なし)'}"]
+            for call_class, c in sorted(self.stats.items()):
+                hits = c["memory_hits"] + c["disk_hits"]; total = hits + c["misses"]
+                rate = hits / total * 100 if total else 0.0
+                lines.append(f"  - {call_class}: ヒット {hits} (メモリ {c['memory_hits']} / ディスク {c['disk_hits']}), "
+                             f"ミス {c['misses']}, 保存 {c['stores']} (ヒット率 {rate:.0f}%)")
+        return "\n".join(lines)
@@ -0,0 +1,137 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+INDEX_FILE_NAME = "search_index.db"
+KIND_MESSAGE, KIND_MEMORY = "message", "memory"
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def format_ms(ts_ms):
+    """ミリ秒のUNIX時刻を「2025-07-10 12:34:56.789」形式にする"""
+    return datetime.fromtimestamp(ts_ms / 1000).strftime("%Y-%m-%d %H:%M:%S.") + f"{ts_ms % 1000:03d}"
+
+def split_line(line):
+    """「名前: 発言」形式の履歴行を (名前, 発言) に分ける"""
+    parts = line.split(":", 1)
+    return (parts[0].strip(), parts[1].strip()) if len(parts) == 2 else ("", line.strip())
+
+class SearchIndex:
+    """
+    保存済みセッションの会話とペルソナの記憶を対象にした全文検索インデックス。
+    SQLite FTS5 の trigram トークナイザで日本語を3文字単位のn-gramとして索引し、bm25で順位付けする。
+    2文字以下の検索語は LIKE による部分一致で検索する。
+    """
+    SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(
+            text, speaker UNINDEXED, session UNINDEXED, kind UNINDEXED, seq UNINDEXED, ts_ms UNINDEXED,
+            tokenize = 'trigram');
+        CREATE TABLE IF NOT EXISTS indexed_sessions (
+            session TEXT PRIMARY KEY, count INTEGER NOT NULL, last_line TEXT NOT NULL);
+    """
+
+    def __init__(self, data_dir):
+        self.db_path = Path(data_dir) / INDEX_FILE_NAME
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM indexed_sessions").fetchone()[0] == 0
+
+    def index_session(self, session_name, history, timestamps_ms=None, history_offset=0):
+        """
+        セッションの履歴を索引に追加する。前回索引した履歴の続きであれば新しい行だけを追加し、
+        履歴が書き換わっている場合はセッション全体を索引し直す。
+        timestamps_ms は各行の発言時刻 (ミリ秒)。無い行は索引した時刻になる。
+        history_offset > 0 (古い行を退避済み) の場合、history は通し番号 history_offset 以降の行で、
+        それより前に索引した行は残す。seq には通し番号を記録する。
+        """
+        now = _now_ms()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT count, last_line FROM indexed_sessions WHERE session = ?", (session_name,)).fetchone()
+                end = history_offset + len(history)
+                start = history_offset
+                if row:
+                    count, last_line = row
+                    if history_offset <= count <= end and (count == history_offset or history[count - 1 - history_offset] == last_line):
+                        start = count
+                    else:
+                        self.conn.execute("DELETE FROM docs WHERE kind = ? AND session = ? AND seq >= ?", (KIND_MESSAGE, session_name, history_offset))
+                rows = []
+                for seq in range(start, end):
+                    i = seq - history_offset
+                    speaker, text = split_line(history[i])
+                    ts_ms = (timestamps_ms[i] if timestamps_ms and i < len(timestamps_ms) else None) or now
+                    rows.append((text, speaker, session_name, KIND_MESSAGE, seq, ts_ms))
+                self.conn.executemany("INSERT INTO docs (text, speaker, session, kind, seq, ts_ms) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("INSERT OR REPLACE INTO indexed_sessions (session, count, last_line) VALUES (?, ?, ?)",
+                                  (session_name, end, history[-1] if history else ""))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return end - start
+
+    def index_memory(self, persona_id, persona_name, summary):
+        """ペルソナの記憶の要約を索引に登録する (既存の記憶は置き換える)"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM docs WHERE kind = ? AND session = ?", (KIND_MEMORY, persona_id))
+                if summary:
+                    self.conn.execute("INSERT INTO docs (text, speaker, session, kind, seq, ts_ms) VALUES (?, ?, ?, ?, ?, ?)",
+                                      (summary, persona_name, persona_id, KIND_MEMORY, None, _now_ms()))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def search(self, query, limit=20):
+        """
+        検索語に一致する発言・記憶を関連度順に返す。
+        各要素は kind, speaker, session, seq, ts_ms, snippet を持つ辞書。
+        """
+        terms = [t for t in query.split() if t]
+        if not terms: return []
+        columns = "kind, speaker, session, seq, ts_ms"
+        if all(len(t) >= 3 for t in terms):
+            # 各語をフレーズとして囲み、AND検索にする
+            match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+            sql = (f"SELECT {columns}, snippet(docs, 0, '【', '】', '…', 16) FROM docs "
+                   f"WHERE docs MATCH ? ORDER BY bm25(docs) LIMIT ?")
+            params = (match, limit)
+        else:
+            conditions = " AND ".join("text LIKE ? ESCAPE '\\'" for _ in terms)
+            sql = f"SELECT {columns}, substr(text, 1, 60) FROM docs WHERE {conditions} ORDER BY ts_ms DESC LIMIT ?"
+            escaped = ["%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for t in terms]
+            params = (*escaped, limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [{"kind": kind, "speaker": speaker, "session": session, "seq": seq, "ts_ms": ts_ms, "snippet": snippet}
+                for kind, speaker, session, seq, ts_ms, snippet in rows]
+
+    def rebuild(self, storage, summaries, persona_manager):
+        """保存済みの全セッションと記憶から索引を作り直す (初回起動時にバックグラウンドで実行)"""
+        for session_name in storage.list_sessions():
+            try:
+                data = storage.load_session(session_name)
+            except Exception as e:
+                print(f"エラー: セッション '{session_name}' の索引作成に失敗: {e}"); continue
+            history = data.get("history", [])
+            timestamps = (list(data.get("timestamps_ms") or []) + [None] * len(history))[:len(history)]
+            if hasattr(storage, "session_file") and not all(timestamps):
+                # 発言時刻のない古いJSONのセッションでは、ファイルの更新時刻を使う
+                mtime_ms = int(storage.session_file(session_name).stat().st_mtime * 1000)
+                timestamps = [ts or mtime_ms for ts in timestamps]
+            self.index_session(session_name, history, timestamps, data.get("history_offset", 0))
+        for persona_id, summary in summaries.items():
+            persona = persona_manager.get_persona_by_id(persona_id)
+            self.index_memory(persona_id, persona.name if persona else persona_id, summary)
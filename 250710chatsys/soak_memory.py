@@ -0,0 +1,109 @@
+"""
+長時間稼働のメモリ試験 (ソークテスト)。
+
+  python soak_memory.py [--turns 100000] [--max-rss-mb 400] [--personas 5]
+
+画面を表示しない本体 (ChatApplication) を、実際のGemini CLIの代わりに固定の応答を返すバックエンドで起動し、
+入力欄への入力 (UIHandler.send_message_event) で --turns 回のターンを進める。応答はアプリと同じく
+ワーカースレッドの get_ai_response で生成され、「入力中...」の置き換え・発言者の表示色・チャット表示・
+記憶更新待ちのバッファ・会話履歴の退避が本体と同じ MemoryGuard の上限のもとで動く。
+一定ターンごとに常駐メモリ (RSS) を表示し、RSS が --max-rss-mb を超えたら終了コード1で終わる。
+データは一時フォルダ (環境変数 MPC_DATA_DIR) に保存し、ペルソナも --personas 人分をそこに作る。
+"""
+import argparse
+import contextlib
+import gc
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PySide6.QtCore import QEventLoop
+from PySide6.QtWidgets import QApplication
+
+from memory_guard import current_rss_bytes, format_mb
+from storage import JsonStorage
+
+class SoakResponder:
+    """ターンごとに異なる固定長の応答を返す (同じ文字列の使い回しでメモリ増加が隠れないようにする)"""
+    def __init__(self, length):
+        self.counter = itertools.count(); self.length = length
+
+    def __call__(self, prompt, call_class=None, persona_id=None):
+        n = next(self.counter)
+        return (f"応答{n} " * self.length)[:self.length]
+
+def build_soak_app(data_dir, persona_count, reply_length):
+    # ペルソナ・設定・記憶・検索インデックスはすべて一時フォルダに置く
+    os.environ["MPC_DATA_DIR"] = data_dir
+    personas = [{"id": f"soak{i}", "name": f"ソーク{i}"} for i in range(persona_count)]
+    with open(os.path.join(data_dir, "personas.json"), 'w', encoding='utf-8') as f: json.dump(personas, f, ensure_ascii=False)
+    storage = JsonStorage(data_dir)
+    storage.save_settings({"user_name": "User"})
+
+    from main import ChatApplication
+    window = ChatApplication(storage=storage, runner=SoakResponder(reply_length))
+    window.show(); window.finish_startup()
+    # 履歴の更新をまとめる待ち時間 (既定30ms) がターンごとの待ちにならないようにする
+    window.conversation_state.flush_timer.setInterval(0)
+    # 応答が画面に反映された回数を数え、ターンの完了を待つのに使う
+    window.soak_replies = 0
+    def count_replies(updates):
+        window.soak_replies += sum(1 for update in updates if update[0] == "reply")
+    window.conversation_state.updates_ready.connect(count_replies)
+    return window
+
+def run_turn(window, turn):
+    qt_app = QApplication.instance(); ui = window.ui
+    if turn % 100 == 0:
+        # ニックネームの変更で発言者が入れ替わる状況も再現する (コマンドも入力欄から実行する)
+        ui.user_input.setText(f"/nick ゲスト{turn // 100}"); ui.send_message_event()
+    expected = window.soak_replies + 1
+    ui.user_input.setText(f"質問その{turn}です。今日の話題について教えてください。"); ui.send_message_event()
+    # ワーカースレッドの応答が「入力中...」と置き換わるまで、GUIスレッドのイベントを処理する
+    while window.soak_replies < expected:
+        qt_app.processEvents(QEventLoop.ProcessEventsFlag.WaitForMoreEvents)
+
+def soak(app, turns, check_every, max_rss_bytes):
+    qt_app = QApplication.instance()
+    peak = 0; started = time.perf_counter()
+    print(f"  {'ターン':>8} {'RSS':>10} {'履歴':>6} {'文脈':>6} {'段落':>6} {'表示色':>6} {'スレッド':>6}")
+    for turn in range(1, turns + 1):
+        # 入力のたびに出る発言のログでコンソールが埋まらないよう、ターン中の標準出力は捨てる
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull): run_turn(app, turn)
+        if turn % check_every == 0 or turn == turns:
+            qt_app.processEvents(); app.memory_guard.compact(); gc.collect()
+            rss = current_rss_bytes() or 0; peak = max(peak, rss)
+            sizes = app.memory_guard.sizes()
+            print(f"  {turn:>8} {format_mb(rss):>10} {sizes['history']:>6} {sizes['history_context']:>6} "
+                  f"{sizes['display_blocks']:>6} {sizes['sender_colors']:>6} {sizes['threads']:>6}", flush=True)
+            if rss > max_rss_bytes:
+                print(f"失敗: RSS {format_mb(rss)} が上限 {format_mb(max_rss_bytes)} を超えました (ターン {turn})")
+                return False
+    print(f"成功: {turns:,} ターン / {time.perf_counter() - started:.1f}s / 最大RSS {format_mb(peak)} (上限 {format_mb(max_rss_bytes)}) / "
+          f"退避した会話履歴 {app.memory_guard.stats['history_spilled']:,} 行")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="固定応答で大量のターンを流し、メモリ使用量が上限内に収まるかを確認する")
+    parser.add_argument("--turns", type=int, default=100000, help="ターン数 (ユーザー発言と応答の組)")
+    parser.add_argument("--max-rss-mb", type=float, default=400.0, help="常駐メモリの上限 (MB)")
+    parser.add_argument("--check-every", type=int, default=5000, help="RSSを確認する間隔 (ターン数)")
+    parser.add_argument("--personas", type=int, default=5, help="参加するペルソナの数")
+    parser.add_argument("--reply-length", type=int, default=200, help="固定応答の文字数")
+    parser.add_argument("--tracemalloc", action="store_true", help="終了時にメモリ割り当ての多い箇所を表示する")
+    args = parser.parse_args()
+
+    if args.tracemalloc: tracemalloc.start()
+    if current_rss_bytes() is None: print("エラー: この環境では常駐メモリを取得できません。"); sys.exit(2)
+    qt_app = QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as data_dir:
+        soak_app = build_soak_app(data_dir, args.personas, args.reply_length)
+        ok = soak(soak_app, args.turns, args.check_every, args.max_rss_mb * 1024 * 1024)
+        if args.tracemalloc: print(soak_app.memory_guard.top_allocations())
+        soak_app.close()
+    sys.exit(0 if ok else 1)
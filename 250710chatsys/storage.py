@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_SETTINGS = {"user_name": "User"}
+DB_FILE_NAME = "chat.db"
+
+def get_data_dir():
+    """
+    設定・学習履歴・セッションを保存するフォルダを返す。
+    カレントディレクトリではなく、アプリ本体 (PyInstaller版は実行ファイル) のあるフォルダを使う。
+    環境変数 MPC_DATA_DIR が指定されていれば、そのフォルダを使う (bench_startup.py などで使用)。
+    """
+    if os.environ.get("MPC_DATA_DIR"):
+        return Path(os.environ["MPC_DATA_DIR"]).resolve()
+    if getattr(sys, "frozen", False):
+        return Path(sys.executable).resolve().parent
+    return Path(__file__).resolve().parent
+
+def create_storage(data_dir=None):
+    """
+    ストレージを生成する。環境変数 MPC_STORAGE=sqlite が指定されているか、
+    既に chat.db が存在する場合は SQLite を使い、それ以外は従来のJSONファイルを使う。
+    """
+    data_dir = Path(data_dir) if data_dir else get_data_dir()
+    db_path = data_dir / DB_FILE_NAME
+    backend = os.environ.get("MPC_STORAGE", "").lower()
+    if backend == "sqlite" or (backend != "json" and db_path.exists()):
+        storage = SQLiteStorage(db_path)
+        migrate_json_to_sqlite(JsonStorage(data_dir), storage)
+        return storage
+    return JsonStorage(data_dir)
+
+# 会話履歴の上限で古い行を退避した後の /save で、保存済みの行を消さないために保存を中止するときのメッセージ
+SPILLED_SESSION_CONFLICT = ("保存済みのセッションと現在の会話履歴がつながらないため、保存を中止しました "
+                            "(古い発言は上限により退避済みのため、上書きすると保存済みの発言が失われます)。別の名前で保存してください。")
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _history_hash(lines):
+    """履歴の行のリストのハッシュ (行の区切りが変わっても一致しないよう、各行の長さも含める)"""
+    digest = hashlib.sha256()
+    for line in lines:
+        encoded = line.encode('utf-8')
+        digest.update(f"{len(encoded)}:".encode('ascii')); digest.update(encoded)
+    return digest.hexdigest()
+
+class JsonStorage:
+    """
+    従来どおり config.json / learning_history.json / token_usage.json / *.session.json に保存するストレージ。
+    """
+    name = "json"
+
+    def __init__(self, data_dir):
+        self.data_dir = Path(data_dir)
+        self.config_file = self.data_dir / "config.json"
+        self.learning_file = self.data_dir / "learning_history.json"
+        self.usage_file = self.data_dir / "token_usage.json"
+        self.lock = threading.RLock()
+
+    def _read(self, path, default):
+        if path.exists():
+            try:
+                with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+            except (json.JSONDecodeError, IOError): pass
+        return default
+
+    def _write(self, path, data):
+        # 一時ファイルに書いてから置き換え、読み込み側が書きかけのファイルを読まないようにする
+        with self.lock:
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, path)
+
+    # --- 設定 ---
+    def load_settings(self): return self._read(self.config_file, dict(DEFAULT_SETTINGS))
+    def save_settings(self, settings): self._write(self.config_file, settings)
+
+    # --- 学習履歴 ---
+    def load_summaries(self): return self._read(self.learning_file, {})
+    def save_summaries(self, summaries): self._write(self.learning_file, summaries)
+
+    def save_summary(self, persona_id, summary):
+        # 複数の記憶更新が同時に保存しても互いの内容を消さないよう、読み込みから書き込みまでをロックする
+        with self.lock:
+            summaries = self.load_summaries(); summaries[persona_id] = summary
+            self.save_summaries(summaries)
+
+    # --- トークン使用量 ---
+    def load_usage(self): return self._read(self.usage_file, None)
+    def save_usage(self, usage): self._write(self.usage_file, usage)
+
+    # --- セッション ---
+    def session_file(self, session_name): return self.data_dir / f"{session_name}.session.json"
+    def session_label(self, session_name): return f"'{self.session_file(session_name).name}'"
+    def session_exists(self, session_name): return self.session_file(session_name).exists()
+    def list_sessions(self): return sorted(p.name[:-len(".session.json")] for p in self.data_dir.glob("*.session.json"))
+
+    def load_session(self, session_name):
+        with open(self.session_file(session_name), 'r', encoding='utf-8') as f: return json.load(f)
+
+    def save_session(self, session_name, session_data):
+        """
+        セッションを保存する。history_offset > 0 (古い行を退避済み) の場合は、保存済みのファイルのうち
+        通し番号 history_offset より前の行を残して続きをつなげる。つながらない場合は ValueError を送出する。
+        """
+        offset = session_data.get("history_offset", 0)
+        with self.lock:
+            path = self.session_file(session_name)
+            if offset and path.exists():
+                session_data = self._merge_spilled(self.load_session(session_name), session_data, offset)
+            self._write(path, session_data)
+
+    @staticmethod
+    def _merge_spilled(saved, session_data, offset):
+        saved_offset = saved.get("history_offset", 0); saved_history = saved.get("history", [])
+        keep = offset - saved_offset # 保存済みの行のうち、退避されて現在の履歴に無い行の数
+        history = session_data.get("history", [])
+        overlap = saved_history[keep:] if 0 <= keep <= len(saved_history) else None
+        if overlap is None or overlap != history[:len(overlap)]: raise ValueError(SPILLED_SESSION_CONFLICT)
+        saved_timestamps = (list(saved.get("timestamps_ms") or []) + [None] * len(saved_history))[:len(saved_history)]
+        return {**session_data, "history": saved_history[:keep] + history, "history_offset": saved_offset,
+                "timestamps_ms": saved_timestamps[:keep] + list(session_data.get("timestamps_ms") or [])}
+
+class SQLiteStorage:
+    """
+    全ての状態を1つのSQLiteデータベース (WALモード) に保存するストレージ。
+    接続はスレッドごとに作るため、ワーカースレッドからも同時に書き込める。
+    SQLはすべて固定文字列のプレースホルダ付きで、sqlite3の文のキャッシュで再利用される。
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS summaries (
+            persona_id TEXT PRIMARY KEY, summary TEXT NOT NULL, updated_ms INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS sessions (
+            name TEXT PRIMARY KEY, user_name TEXT NOT NULL, active_persona_ids TEXT NOT NULL, updated_ms INTEGER NOT NULL,
+            history_hash TEXT);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL, seq INTEGER NOT NULL,
+            line TEXT NOT NULL, created_ms INTEGER NOT NULL, UNIQUE (session, seq));
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.data_dir = self.db_path.parent
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        # history_hash 列が無い古いデータベースには列を追加する (値が無いセッションは次の保存で全体を書き直す)
+        if "history_hash" not in [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]:
+            conn.execute("ALTER TABLE sessions ADD COLUMN history_hash TEXT")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _write(self, statements):
+        """(SQL, パラメータ) のリストを1つのトランザクションで実行する。パラメータがlistなら複数行を挿入する。"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                if isinstance(params, list): conn.executemany(sql, params)
+                else: conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        """呼び出し元スレッドの接続を閉じる"""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close(); self.local.conn = None
+
+    # --- メタ情報 ---
+    def get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self._write([("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))])
+
+    # --- 設定 ---
+    def load_settings(self):
+        rows = self._conn().execute("SELECT key, value FROM settings").fetchall()
+        return {key: json.loads(value) for key, value in rows} if rows else dict(DEFAULT_SETTINGS)
+
+    def save_settings(self, settings):
+        rows = [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+        self._write([("DELETE FROM settings", ()), ("INSERT INTO settings (key, value) VALUES (?, ?)", rows)])
+
+    # --- 学習履歴 ---
+    def load_summaries(self):
+        return dict(self._conn().execute("SELECT persona_id, summary FROM summaries").fetchall())
+
+    def save_summaries(self, summaries):
+        now = _now_ms()
+        rows = [(pid, summary, now) for pid, summary in summaries.items()]
+        self._write([("DELETE FROM summaries", ()), ("INSERT INTO summaries (persona_id, summary, updated_ms) VALUES (?, ?, ?)", rows)])
+
+    def save_summary(self, persona_id, summary):
+        self._write([("INSERT OR REPLACE INTO summaries (persona_id, summary, updated_ms) VALUES (?, ?, ?)", (persona_id, summary, _now_ms()))])
+
+    # --- トークン使用量 ---
+    def load_usage(self): return self.get_meta("token_usage")
+    def save_usage(self, usage): self.set_meta("token_usage", usage)
+
+    # --- セッション ---
+    def session_label(self, session_name): return f"'{session_name}' ({self.db_path.name})"
+
+    def session_exists(self, session_name):
+        return self._conn().execute("SELECT 1 FROM sessions WHERE name = ?", (session_name,)).fetchone() is not None
+
+    def list_sessions(self):
+        return [row[0] for row in self._conn().execute("SELECT name FROM sessions ORDER BY name")]
+
+    def load_session(self, session_name):
+        conn = self._conn()
+        row = conn.execute("SELECT user_name, active_persona_ids FROM sessions WHERE name = ?", (session_name,)).fetchone()
+        if row is None: raise KeyError(session_name)
+        rows = conn.execute("SELECT seq, line, created_ms FROM messages WHERE session = ? ORDER BY seq", (session_name,)).fetchall()
+        # 古い行を退避した後に初めて保存したセッションは、通し番号 (seq) が 0 からではなく途中から始まる
+        return {"history": [line for _, line, _ in rows], "timestamps_ms": [created_ms for _, _, created_ms in rows],
+                "history_offset": rows[0][0] if rows else 0, "active_persona_ids": json.loads(row[1]), "user_name": row[0]}
+
+    def save_session(self, session_name, session_data):
+        """
+        セッションを保存する。保存済みの履歴全体が現在の履歴の先頭部分と一致する場合は (ハッシュで比較)、
+        新しいメッセージだけを追記する。別の会話を同じ名前で保存した場合や、圧縮などで履歴が変わっている場合は全体を書き直す。
+        history_offset > 0 (古い行を退避済み) の場合、history は通し番号 history_offset 以降の行なので、
+        保存済みの行のうちそれより前のものは残し、保存済みの続きから追記する。保存済みの行と食い違う場合や、
+        退避された行が保存されておらず間が空く場合は、保存済みの行を消さないよう ValueError を送出する。
+        """
+        history = session_data.get("history", []); offset = session_data.get("history_offset", 0)
+        conn = self._conn()
+        saved_count, saved_end = conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session = ?", (session_name,)).fetchone()
+        statements = [(
+            "INSERT OR REPLACE INTO sessions (name, user_name, active_persona_ids, updated_ms, history_hash) VALUES (?, ?, ?, ?, ?)",
+            (session_name, session_data.get("user_name", "User"), json.dumps(session_data.get("active_persona_ids", []), ensure_ascii=False),
+             # 退避済みの行はメモリに無くハッシュを計算できないため、記録しない (次に全体を保存するときに書き直す)
+             _now_ms(), _history_hash(history) if offset == 0 else None)
+        )]
+        if offset:
+            saved = [line for (line,) in conn.execute(
+                "SELECT line FROM messages WHERE session = ? AND seq >= ? ORDER BY seq", (session_name, offset))]
+            if saved_count and (saved_end < offset or saved != history[:len(saved)]): raise ValueError(SPILLED_SESSION_CONFLICT)
+            start = offset + len(saved)
+        else:
+            start = saved_count
+            if saved_count:
+                row = conn.execute("SELECT history_hash FROM sessions WHERE name = ?", (session_name,)).fetchone()
+                if saved_count > len(history) or row is None or row[0] != _history_hash(history[:saved_count]):
+                    statements.append(("DELETE FROM messages WHERE session = ?", (session_name,)))
+                    start = 0
+        new_lines = history[start - offset:]
+        if new_lines:
+            timestamps_ms = session_data.get("timestamps_ms") or []
+            statements.append(self._append_statement(session_name, start, new_lines, timestamps_ms[start - offset:]))
+        self._write(statements)
+
+    def _append_statement(self, session_name, start, lines, timestamps_ms):
+        # 発言時刻が分からない行 (時刻のない古いセッションなど) は保存時刻にする
+        now = _now_ms()
+        rows = [(session_name, start + i, line, (timestamps_ms[i] if i < len(timestamps_ms) else None) or now)
+                for i, line in enumerate(lines)]
+        return ("INSERT INTO messages (session, seq, line, created_ms) VALUES (?, ?, ?, ?)", rows)
+
+def migrate_json_to_sqlite(json_storage, sqlite_storage):
+    """既存のJSONファイルの内容をSQLiteへ一度だけ取り込む。元のJSONファイルはそのまま残す。"""
+    if sqlite_storage.get_meta("migrated_from_json"): return
+    imported = []
+    if json_storage.config_file.exists():
+        sqlite_storage.save_settings(json_storage.load_settings()); imported.append(json_storage.config_file.name)
+    if json_storage.learning_file.exists():
+        sqlite_storage.save_summaries(json_storage.load_summaries()); imported.append(json_storage.learning_file.name)
+    usage = json_storage.load_usage()
+    if usage:
+        sqlite_storage.save_usage(usage); imported.append(json_storage.usage_file.name)
+    for session_name in json_storage.list_sessions():
+        try:
+            if not sqlite_storage.session_exists(session_name):
+                sqlite_storage.save_session(session_name, json_storage.load_session(session_name))
+                imported.append(json_storage.session_file(session_name).name)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"エラー: セッション '{session_name}' の移行に失敗: {e}")
+    sqlite_storage.set_meta("migrated_from_json", {"at_ms": _now_ms(), "files": imported})
+    if imported:
+        print(f"情報: {len(imported)}個のJSONファイルを '{sqlite_storage.db_path.name}' に移行しました。")
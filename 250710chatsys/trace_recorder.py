@@ -0,0 +1,64 @@
+import itertools
+import json
+import threading
+import time
+from pathlib import Path
+
+class TraceRecorder:
+    """
+    ユーザー操作・コマンド・バックエンドへの要求と応答を、時刻付きでトレースファイル (JSON Lines) に記録するクラス。
+    記録したトレースは replay_trace.py で再生できる。
+    各行は {"t_ms": 記録開始からの経過ミリ秒, "kind": 種類, ...} の形式。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.started = 0.0
+        self.request_ids = itertools.count(1)
+
+    @property
+    def is_active(self):
+        return self.file is not None
+
+    def start(self, path):
+        self.stop()
+        self.path = Path(path)
+        with self.lock:
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self.started = time.perf_counter()
+        self.record("trace_start", wall_ms=int(time.time() * 1000))
+        print(f"情報: トレースの記録を開始しました: {self.path}")
+
+    def stop(self):
+        if not self.is_active: return None
+        self.record("trace_stop")
+        with self.lock:
+            self.file.close(); self.file = None
+        print(f"情報: トレースの記録を終了しました: {self.path}")
+        return self.path
+
+    def record(self, kind, **fields):
+        if not self.is_active: return
+        with self.lock:
+            if self.file is None: return
+            event = {"t_ms": round((time.perf_counter() - self.started) * 1000, 3), "kind": kind, **fields}
+            self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def begin_request(self, call_class, persona_id, prompt):
+        """バックエンドへの要求を記録し、応答と対応付けるためのIDを返す。記録中でなければ None。"""
+        if not self.is_active: return None
+        request_id = next(self.request_ids)
+        self.record("backend_request", id=request_id, call_class=call_class, persona_id=persona_id, prompt=prompt)
+        return request_id
+
+    def end_request(self, request_id, latency_ms, response=None, error=None):
+        if request_id is None: return
+        self.record("backend_response", id=request_id, latency_ms=round(latency_ms, 3),
+                    ok=error is None, response=response, error=error)
+
+def load_trace(path):
+    """トレースファイルを読み込み、イベントのリストを返す"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
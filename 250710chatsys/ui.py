@@ -1,31 +1,56 @@
-import sys
 import subprocess
 import threading
 import random
-import json
 import time
 
 from PySide6.QtWidgets import (
-    QApplication, QMainWindow, QTextEdit, QLineEdit,
+    QTextEdit, QLineEdit,
     QPushButton, QVBoxLayout, QHBoxLayout, QWidget,
     QListWidget, QLabel, QGroupBox, QSizePolicy,
-    QFormLayout, QSlider
+    QFormLayout, QSlider, QDialog, QListWidgetItem
 )
 from PySide6.QtCore import Slot, Signal, QObject, Qt, QTimer
 from PySide6.QtGui import QTextCursor, QFont
 
 class Communicate(QObject):
-    user_response_received = Signal(str, str)
-    debate_thinking = Signal(str)
-    debate_response_received = Signal(str, str)
-    system_message = Signal(str)
     conclusion_finished = Signal()
+    personas_changed = Signal(object)
+
+class SearchResultsDialog(QDialog):
+    """/search の検索結果一覧。発言をクリックすると、そのセッションの該当箇所を開く。"""
+    def __init__(self, ui, query, hits):
+        # 検索を使うまで search_index (sqlite3 など) を読み込まないよう、ここでインポートする
+        from search_index import KIND_MEMORY, format_ms
+        super().__init__(ui.app)
+        self.ui = ui
+        self.setWindowTitle(f"検索結果: {query}")
+        self.resize(700, 450)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(f"「{query}」の検索結果 {len(hits)}件 (クリックで該当箇所を開きます)"))
+        self.result_list = QListWidget(); layout.addWidget(self.result_list)
+        for hit in hits:
+            if hit["kind"] == KIND_MEMORY: location = f"{hit['speaker']}の記憶"
+            else: location = f"セッション '{hit['session']}' #{hit['seq'] + 1} {hit['speaker']}"
+            item = QListWidgetItem(f"[{format_ms(hit['ts_ms'])}] {location}\n    {hit['snippet']}")
+            item.setData(Qt.ItemDataRole.UserRole, hit)
+            self.result_list.addItem(item)
+        self.result_list.itemClicked.connect(self.open_hit)
+
+    @Slot(QListWidgetItem)
+    def open_hit(self, item):
+        from search_index import KIND_MEMORY
+        hit = item.data(Qt.ItemDataRole.UserRole)
+        if hit["kind"] == KIND_MEMORY:
+            summary = self.ui.learning_manager.get_summary_for(hit["session"])
+            self.ui.display_message("System", f"{hit['speaker']}の記憶:\n{summary}")
+        else:
+            self.ui.config_manager.open_session_at(hit["session"], hit["seq"])
 
 class UIHandler:
     def __init__(self, app):
         self.app = app
         self.comm = Communicate()
-        self.history = []
+        self.state = self.app.conversation_state
         self.base_font_size = 14
         self.persona_manager = self.app.persona_manager
         self.config_manager = self.app.config_manager
@@ -34,11 +59,16 @@ class UIHandler:
         self.sender_colors = {}
         self.autochat_timer = QTimer()
         self.autochat_timer.setSingleShot(True)
-        self.autochat_timer.setInterval(15000)
+        self.autochat_timer.setInterval(int(15000 * self.app.time_scale))
         self.autochat_timer.timeout.connect(self.start_autochat)
 
     def link_debate_manager(self, manager): self.debate_manager = manager
 
+    @property
+    def history(self):
+        """会話履歴 (変更は ConversationState を通して行う)"""
+        return self.state.history
+
     def setup_ui(self):
         central_widget = QWidget(); self.app.setCentralWidget(central_widget)
         root_layout = QHBoxLayout(central_widget)
@@ -56,11 +86,9 @@ class UIHandler:
         self.debate_start_button.clicked.connect(self.start_debate)
         self.debate_stop_button.clicked.connect(self.conclude_debate_event)
         self.font_slider.valueChanged.connect(self.update_font_size)
-        self.comm.user_response_received.connect(self.handle_ai_response)
-        self.comm.debate_thinking.connect(self.handle_autochat_thinking)
-        self.comm.debate_response_received.connect(self.handle_autochat_response)
-        self.comm.system_message.connect(self.handle_system_message)
+        self.state.updates_ready.connect(self.apply_updates)
         self.comm.conclusion_finished.connect(self.on_conclusion_finished)
+        self.comm.personas_changed.connect(self.handle_personas_changed)
 
         self.user_input.setFocus()
         self.update_font_size(self.base_font_size)
@@ -136,12 +164,14 @@ class UIHandler:
         self.on_user_typing()
         theme = self.debate_theme_input.text().strip()
         if not theme: self.display_message("System", "討論テーマを入力してください。"); return
+        self.app.trace_recorder.record("debate_start", theme=theme)
         if self.debate_manager:
             self.set_debate_buttons_enabled(False)
             self.debate_manager.start_debate(theme)
 
     @Slot()
     def conclude_debate_event(self):
+        self.app.trace_recorder.record("debate_stop")
         if self.debate_manager: self.debate_manager.conclude_debate()
     
     @Slot()
@@ -163,15 +193,16 @@ class UIHandler:
         
         if user_text.startswith('/'):
             print(f"\n[Command]: {user_text}")
+            self.app.trace_recorder.record("command", text=user_text)
             self.config_manager.execute_command(user_text)
             return
 
         print(f"\n[{self.config_manager.user_name}]: {user_text}")
-        self.history.append(f"{self.config_manager.user_name}: {user_text}")
-        self.display_message(self.config_manager.user_name, user_text)
+        self.app.trace_recorder.record("user_message", text=user_text)
+        is_debating = bool(self.debate_manager and self.debate_manager.is_debating)
+        self.state.add_message(self.config_manager.user_name, user_text, to_context=is_debating)
 
-        if self.debate_manager and self.debate_manager.is_debating:
-            self.debate_manager.history_context.append(f"{self.config_manager.user_name}: {user_text}")
+        if is_debating:
             print("情報: ユーザーが討論に参加しました。次のAIのターンを待ちます。")
             return
 
@@ -185,50 +216,68 @@ class UIHandler:
         if speaker is None:
             speaker = random.choice(active_personas); print(f"情報: ランダムで {speaker.name} が応答します。")
 
-        self.display_message(speaker.name, "入力中...")
+        self.state.show_typing(speaker.name)
         threading.Thread(target=self.get_ai_response, args=(user_text, speaker), daemon=True).start()
 
     def trigger_all_personas_response(self, question):
-        user_text = f"{self.config_manager.user_name}: (全員へ) {question}"
-        self.history.append(user_text)
-        self.display_message(self.config_manager.user_name, f"(全員へ) {question}")
+        self.state.add_message(self.config_manager.user_name, f"(全員へ) {question}")
         threading.Thread(target=self._ask_all_worker, args=(question,), daemon=True).start()
 
     def _ask_all_worker(self, question):
         active_personas = self.persona_manager.get_active_personas()
         if not active_personas: return
+        if self.config_manager.settings.get("ask_all_batched", False) and len(active_personas) > 1:
+            # 一括生成で応答が得られなかったペルソナだけを、従来どおり1人ずつ生成する
+            active_personas = self._ask_all_batched(question, active_personas)
         for speaker in active_personas:
-            self.comm.debate_thinking.emit(speaker.name)
-            self.get_ai_response(question, speaker)
-            time.sleep(random.uniform(2, 4))
+            self.state.show_typing(speaker.name)
+            self.get_ai_response(question, speaker, call_class="ask_all")
+            time.sleep(random.uniform(2, 4) * self.app.time_scale)
             
-    def get_ai_response(self, prompt_text, speaker):
+    def _ask_all_batched(self, question, personas):
+        """全員分の応答を1回の呼び出しで生成して履歴に追加し、応答が得られなかったペルソナのリストを返す"""
+        from batch_response import parse_batch_response # 一括生成モードでしか使わない
+        last_line = self.state.recent_history(1)
+        self.state.show_typing("全員")
+        try:
+            # トークン数は /budget のペルソナ別集計のため、参加者全員に等分して記録する
+            response = self.app.backend.generate(self.build_batch_prompt(question, personas), "ask_all_batch", [p.id for p in personas])
+            answers = parse_batch_response(response or "", {p.id: p.name for p in personas})
+        except Exception as e:
+            print(f"エラー: /ask_all の一括生成に失敗しました: {e}"); answers = {}
+
+        for speaker in personas:
+            if speaker.id not in answers: continue
+            ai_text = answers[speaker.id]
+            self.state.add_message(speaker.name, ai_text, display="reply")
+            self.learning_manager.add_to_buffer(speaker.id, "\n".join(last_line + [f"{speaker.name}: {ai_text}"]))
+        missing = [p for p in personas if p.id not in answers]
+        if missing:
+            print(f"情報: 一括生成で応答が得られなかった {len(missing)} 人を個別に生成します。")
+            if not answers: self.state.show_reply("System", "一括生成に失敗したため、1人ずつ応答を生成します。")
+        return missing
+
+    def get_ai_response(self, prompt_text, speaker, call_class="chat"):
+        # ワーカースレッドで実行される。履歴の変更は ConversationState にイベントとして渡す
         final_prompt = self.build_prompt(prompt_text, speaker)
-        ai_text = ""
+        last_line = self.state.recent_history(1)
         try:
-            # ▼▼▼ 修正箇所 ▼▼▼
-            # シンプルな単一モデル呼び出しに戻す
-            command = [self.app.gemini_path, "--model", self.app.model_name]
-            result = subprocess.run(
-                command, input=final_prompt, text=True, encoding='utf-8',
-                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            ai_text = result.stdout.strip() or "(...)"
-            self.history.append(f"{speaker.name}: {ai_text}")
-            turn_context = f"{self.history[-2]}\n{self.history[-1]}"
-            self.learning_manager.add_to_buffer(speaker.id, turn_context)
-            # ▲▲▲ 修正箇所 ▲▲▲
+            ai_text = self.app.backend.generate(final_prompt, call_class, speaker.id) or "(...)"
         except Exception as e:
             error_message = f"エラーが発生しました: {e}"
             if isinstance(e, subprocess.CalledProcessError):
                 error_message = f"AI応答エラー: {e.stderr.strip()}"
             print(error_message)
-            ai_text = error_message
+            # エラーは画面に表示するだけで、会話履歴には残さない
+            self.state.show_reply(speaker.name, error_message, restart_autochat=True)
+            return
 
-        self.comm.user_response_received.emit(ai_text, speaker.name)
+        self.state.add_message(speaker.name, ai_text, display="reply", restart_autochat=True)
+        turn_context = "\n".join(last_line + [f"{speaker.name}: {ai_text}"])
+        self.learning_manager.add_to_buffer(speaker.id, turn_context)
 
     def build_prompt(self, user_prompt, speaker):
-        recent_history = "\n".join(self.history[-10:])
+        recent_history = "\n".join(self.state.recent_history(self.app.budget_manager.history_window(10)))
         persona_prompt = speaker.get_prompt_string()
         
         learning_summary = self.learning_manager.get_summary_for(speaker.id)
@@ -253,20 +302,55 @@ class UIHandler:
                 f"--- 会話履歴 ---\n{recent_history}\n--- 会話履歴ここまで ---\n\n"
                 f"{last_statement_line}: \"{user_prompt.replace('(全員へ)','')}\"\n\nあなたの応答:")
 
-    @Slot(str, str)
-    def handle_ai_response(self, ai_text, speaker_name):
-        self.update_last_message(speaker_name, ai_text); self.autochat_timer.start()
-
-    @Slot(str)
-    def handle_autochat_thinking(self, speaker_name):
-        self.display_message(speaker_name, "入力中...")
-
-    @Slot(str, str)
-    def handle_autochat_response(self, speaker_name, message):
-        self.update_last_message(speaker_name, message)
-
-    @Slot(str)
-    def handle_system_message(self, message): self.display_message("System", message)
+    def build_batch_prompt(self, question, personas):
+        # 会話履歴と指示は1回だけ含め、ペルソナごとの設定と記憶の要約を並べる
+        recent_history = "\n".join(self.state.recent_history(self.app.budget_manager.history_window(10)))
+        cards = []
+        for persona in personas:
+            card = f"=== id: {persona.id} ===\n{persona.get_prompt_string()}"
+            learning_summary = self.learning_manager.get_summary_for(persona.id)
+            if learning_summary: card += f"--- {persona.name}の記憶の要約 ---\n{learning_summary}\n"
+            cards.append(card)
+        ids = ", ".join(f'"{p.id}"' for p in personas)
+
+        return ("これから複数のAIペルソナが、全員に向けられた同じ質問にそれぞれ応答します。\n"
+                "以下の各ペルソナの設定（「あなた」はそれぞれのペルソナを指します）と会話履歴を踏まえ、全員分の応答を作成してください。\n\n"
+                + "\n".join(cards) +
+                f"\n--- 会話履歴 ---\n{recent_history}\n--- 会話履歴ここまで ---\n\n"
+                f"全員に向けられた質問: \"{question}\"\n\n"
+                "出力形式:\n"
+                "- 次の形式のJSONだけを出力してください。説明文やコードブロックは不要です。\n"
+                '  {"responses": [{"id": "ペルソナのid", "text": "そのペルソナの応答"}, ...]}\n'
+                f"- id は {ids} のそれぞれについて1つずつ、この順番で含めてください。\n"
+                "- 各ペルソナは自分の設定と記憶だけに基づいて話し、他のペルソナの応答を真似しないでください。\n"
+                "- text にはペルソナの名前を含めず、長くなる場合は適度に改行 (\\n) を入れてください。")
+
+    @Slot(list)
+    def apply_updates(self, updates):
+        # ConversationState がまとめて届けた画面の更新を、GUIスレッドで順番に反映する
+        for update in updates:
+            kind = update[0]
+            if kind == "message": self.display_message(update[1], update[2], update[3])
+            elif kind == "typing": self.display_message(update[1], "入力中...")
+            elif kind == "reply":
+                self.update_last_message(update[1], update[2], update[4])
+                if update[3]: self.autochat_timer.start()
+            elif kind == "redraw": self.redraw_history()
+
+    def redraw_history(self):
+        self.chat_display.clear()
+        offset = self.state.history_offset
+        for i, line in enumerate(self.history):
+            parts = line.split(":", 1)
+            if len(parts) == 2:
+                self.display_message(parts[0].strip(), parts[1].strip(), offset + i)
+
+    @Slot(object)
+    def handle_personas_changed(self, changes):
+        # PersonaWatcher のスレッドから届いた差分を、GUIスレッドで反映する
+        message = self.persona_manager.apply_changes(changes)
+        self.update_participant_list()
+        if message: self.display_message("System", f"ペルソナ設定を再読み込みしました。\n{message}")
 
     def get_sender_color(self, sender):
         if sender == "System": return "#B0B0B0"
@@ -281,16 +365,18 @@ class UIHandler:
             self.sender_colors[sender] = f"#{r:02x}{g:02x}{b:02x}"
         return self.sender_colors[sender]
 
-    def display_message(self, sender, message):
+    def display_message(self, sender, message, history_index=None):
         name_color = self.get_sender_color(sender)
         safe_message = (message.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace(chr(10), "<br>"))
         html = (f'<p style="margin-bottom: 8px; margin-left: 5px;">'
                 f'<b style="color: {name_color};">{sender}</b><br>'
                 f'<span style="margin-left: 10px;">{safe_message}</span></p>')
         self.chat_display.append(html)
+        # 履歴から表示した段落には履歴の通し番号を記録しておく (検索結果からの移動に使う)
+        if history_index is not None: self.chat_display.document().lastBlock().setUserState(history_index)
         self.chat_display.moveCursor(QTextCursor.MoveOperation.End)
 
-    def update_last_message(self, sender, message):
+    def update_last_message(self, sender, message, history_index=None):
         cursor = self.chat_display.textCursor(); cursor.movePosition(QTextCursor.MoveOperation.End)
         cursor.select(QTextCursor.SelectionType.BlockUnderCursor)
         if "入力中..." in cursor.selection().toHtml():
@@ -298,12 +384,26 @@ class UIHandler:
             new_cursor = self.chat_display.textCursor(); new_cursor.movePosition(QTextCursor.MoveOperation.End)
             new_cursor.select(QTextCursor.SelectionType.BlockUnderCursor)
             if not new_cursor.hasSelection() or new_cursor.selectedText().strip() == "": new_cursor.removeSelectedText()
-        self.display_message(sender, message)
+        self.display_message(sender, message, history_index)
+
+    def show_search_results(self, query, hits):
+        self.search_dialog = SearchResultsDialog(self, query, hits)
+        self.search_dialog.show()
+
+    def scroll_to_history_index(self, index):
+        """履歴の通し番号 index (退避済みの行も数えた番号) の発言が表示されている位置までスクロールし、選択状態にする"""
+        # System の表示などが間に入り、古い段落は上限を超えると先頭から消えるため、
+        # 段落の番号ではなく display_message で記録した履歴の通し番号で探す
+        block = self.chat_display.document().lastBlock()
+        while block.isValid() and block.userState() != index: block = block.previous()
+        if not block.isValid(): return
+        cursor = QTextCursor(block); cursor.select(QTextCursor.SelectionType.BlockUnderCursor)
+        self.chat_display.setTextCursor(cursor); self.chat_display.ensureCursorVisible()
 
     @Slot()
     def clear_history(self):
-        self.history.clear()
-        if self.debate_manager: self.debate_manager.history_context.clear()
+        self.app.trace_recorder.record("clear_history")
+        self.state.clear()
         self.learning_manager.summaries.clear()
         self.learning_manager.save_summaries()
-        self.chat_display.clear(); self.display_message("System", "会話履歴と学習履歴がクリアされました。"); self.on_user_typing()
+        self.display_message("System", "会話履歴と学習履歴がクリアされました。"); self.on_user_typing()